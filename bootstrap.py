@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""Bootstrap confidence intervals for arbitrary statistics.
+
+Statistics here work on batches: a statistic is a function that takes one
+array of shape (batch, n) for each data array and returns an array of shape
+(batch,), one value per row.  Resamples are drawn as whole matrices of
+indices, so a statistic like batch_mean computes thousands of bootstrap
+replicates with a single numpy call.  Passing a tuple of arrays resamples them
+together (the same indices for each), which is what you want for paired data.
+
+With processes != 1 the statistic is sent to worker processes, so it has to be
+picklable (i.e., defined at the top level of a module, not a lambda).
+"""
+
+from __future__ import division
+
+import numpy
+
+from stats import map_jobs
+
+
+def batch_mean(batch):
+    return batch.mean(axis=1)
+
+
+def batch_median(batch):
+    return numpy.median(batch, axis=1)
+
+
+def batch_mean_difference(batch1, batch2):
+    return (batch1 - batch2).mean(axis=1)
+
+
+def resample_indices(n, num_samples, random, batch_size=None):
+    """Yields arrays of bootstrap resample indices, each of shape (batch, n),
+    with num_samples rows in all.  random is a numpy RandomState.
+
+    The default batch size keeps each matrix to a few million entries.
+    """
+    if not batch_size:
+        batch_size = max(1, 2**22 // n)
+    while num_samples > 0:
+        batch = min(batch_size, num_samples)
+        num_samples -= batch
+        yield random.randint(n, size=(batch, n))
+
+
+def bootstrap_distribution(data, statistic=batch_mean, num_samples=10000,
+        seed=None, processes=1, batch_size=None):
+    """Computes statistic on num_samples bootstrap resamples of data.
+
+    data is an array, or a tuple of arrays of the same length that are
+    resampled together.  Returns an array of num_samples values.  seed makes
+    the result reproducible, and processes splits the samples across that
+    many worker processes (None for one per core).
+    """
+    arrays = _as_arrays(data)
+    results = map_jobs(_bootstrap_job, (arrays, statistic, batch_size),
+            num_samples, seed, processes)
+    return numpy.concatenate(results)
+
+
+def _bootstrap_job(job):
+    (arrays, statistic, batch_size), num_samples, seed = job
+    random = numpy.random.RandomState(seed)
+    results = [numpy.zeros(0)]
+    for indices in resample_indices(len(arrays[0]), num_samples, random,
+            batch_size):
+        results.append(numpy.asarray(statistic(*[a[indices] for a in
+            arrays]), dtype=float))
+    return numpy.concatenate(results)
+
+
+def percentile_interval(data, statistic=batch_mean, confidence=.95,
+        num_samples=10000, seed=None, processes=1, batch_size=None):
+    """Finds a bootstrap confidence interval for statistic on data by taking
+    percentiles of the bootstrap distribution.
+
+    Returns (low, high).  See bootstrap_distribution for the arguments.
+    """
+    boot = bootstrap_distribution(data, statistic, num_samples, seed,
+            processes, batch_size)
+    alpha = (1 - confidence) / 2
+    low, high = numpy.percentile(boot, [100 * alpha, 100 * (1 - alpha)])
+    return low, high
+
+
+def bca_interval(data, statistic=batch_mean, confidence=.95,
+        num_samples=10000, seed=None, processes=1, batch_size=None,
+        jackknife_groups=100):
+    """Finds a bias-corrected and accelerated (BCa) bootstrap confidence
+    interval for statistic on data.
+
+    BCa shifts the percentiles of the bootstrap distribution to correct for
+    bias (estimated from how much of the distribution is below the statistic
+    on the full data) and skew (estimated from a grouped jackknife: the items
+    are dealt into jackknife_groups groups, and statistic is evaluated with
+    each group left out in turn, so the cost grows linearly with n rather
+    than quadratically).  It is more accurate than percentile_interval for
+    skewed statistics.
+
+    Returns (low, high).  See bootstrap_distribution for the other
+    arguments.
+    """
+    from scipy.special import ndtr, ndtri
+    arrays = _as_arrays(data)
+    boot = bootstrap_distribution(arrays, statistic, num_samples, seed,
+            processes, batch_size)
+    estimate = _evaluate(statistic, arrays)
+    below = ((boot < estimate).sum() + (boot == estimate).sum() / 2)
+    bias = ndtri(below / len(boot))
+    jack = _jackknife(arrays, statistic, jackknife_groups, batch_size)
+    jack = jack.mean() - jack
+    denominator = 6 * ((jack**2).sum())**1.5
+    acceleration = (jack**3).sum() / denominator if denominator else 0
+    alpha = (1 - confidence) / 2
+    percentiles = []
+    for z in ndtri(alpha), ndtri(1 - alpha):
+        shifted = bias + z
+        percentiles.append(100 * ndtr(bias + shifted /
+            (1 - acceleration * shifted)))
+    if numpy.isnan(percentiles).any():
+        # All of the bootstrap replicates were on one side of the estimate;
+        # there's nothing to correct with.
+        percentiles = [100 * alpha, 100 * (1 - alpha)]
+    low, high = numpy.percentile(boot, percentiles)
+    return low, high
+
+
+def paired_bootstrap(data1, data2, statistic=batch_mean, confidence=.95,
+        method='bca', num_samples=10000, seed=None, processes=1,
+        batch_size=None):
+    """Finds a confidence interval for the difference statistic(data1) -
+    statistic(data2), resampling the pairs together.
+
+    This is the bootstrap counterpart of stats.paired_permutation_test: if
+    the interval doesn't contain 0, the difference is significant.  method is
+    'bca' or 'percentile'.  Returns (low, high).
+    """
+    if len(data1) != len(data2):
+        raise ValueError('This is a _paired_ test and you gave me data with'
+                ' unequal lengths!')
+    if method == 'bca':
+        interval = bca_interval
+    elif method == 'percentile':
+        interval = percentile_interval
+    else:
+        raise ValueError('Unknown method: %s' % method)
+    data = (numpy.asarray(data1, dtype=float),
+            numpy.asarray(data2, dtype=float))
+    return interval(data, _PairedDifference(statistic), confidence,
+            num_samples, seed, processes, batch_size)
+
+
+class _PairedDifference(object):
+    """A picklable statistic for the difference between two batches."""
+    def __init__(self, statistic):
+        self.statistic = statistic
+
+    def __call__(self, batch1, batch2):
+        return self.statistic(batch1) - self.statistic(batch2)
+
+
+def _as_arrays(data):
+    if isinstance(data, tuple):
+        arrays = tuple(numpy.asarray(a) for a in data)
+    else:
+        arrays = (numpy.asarray(data),)
+    if len(set(len(a) for a in arrays)) != 1:
+        raise ValueError('Arrays resampled together must have equal lengths')
+    return arrays
+
+
+def _evaluate(statistic, arrays):
+    """statistic on the data itself, as a batch of one."""
+    return float(statistic(*[a[numpy.newaxis] for a in arrays])[0])
+
+
+def _jackknife(arrays, statistic, groups, batch_size=None):
+    """statistic on the arrays with each of groups groups of items left out,
+    where item i is in group i % groups.  With groups >= n, that's the n
+    leave-one-out subsets."""
+    n = len(arrays[0])
+    groups = max(1, min(n, groups))
+    if not batch_size:
+        batch_size = max(1, 2**22 // n)
+    items = numpy.arange(n)
+    group = items % groups
+    results = []
+    # The first n % groups groups have one more item than the rest, so their
+    # subsets are one item shorter; each batch only has one size.
+    bigger = n % groups
+    for first, last in (0, bigger), (bigger, groups):
+        for start in xrange(first, last, batch_size):
+            rows = numpy.arange(start, min(last, start + batch_size))
+            keep = group != rows[:,numpy.newaxis]
+            indices = numpy.nonzero(keep)[1].reshape(len(rows), -1)
+            results.append(numpy.asarray(statistic(*[a[indices] for a in
+                arrays]), dtype=float))
+    return numpy.concatenate(results)
+
+
+# vim: et sw=4 sts=4
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 from __future__ import division
-from numpy import zeros, array
+from numpy import zeros, array, asarray
+from itertools import islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy
+import os
 from evilplot import Plot, Points
 
 def main():
@@ -43,13 +48,64 @@ def do_balance_HAC():
         if grouping[0] != 0:
             print grouping[0], grouping[1], grouping[2].error()
 
-def make_matrix(data, n=2):
-    matrix = zeros((len(data),len(data)))
-    for i in range(len(data)):
-        for j in range(len(data)):
-            matrix[i,j] = norm(data[i],data[j], n)
+def make_matrix(data, n=2, block_size=256, threads=None):
+    """Returns the matrix of distances between every pair of data points.
+    Only the upper triangle is computed, a block of rows at a time, and
+    mirrored into the lower one; see make_condensed_matrix."""
+    points = asarray(data, dtype=float)
+    matrix = zeros((len(points),len(points)))
+    def fill(start):
+        end = start + block_size
+        strip = minkowski_distances(points[start:end], points[start:], n)
+        matrix[start:end,start:] = strip
+        matrix[start:,start:end] = strip.T
+    map_blocks(fill, len(points), block_size, threads)
+    numpy.fill_diagonal(matrix, 0)
     return matrix
 
+def make_condensed_matrix(data, n=2, filename=None, block_size=64,
+        threads=None):
+    """Returns the distances between every pair of data points i < j,
+    condensed into a vector of n(n-1)/2 entries in the same order as
+    scipy.spatial.distance.pdist: (0, 1), (0, 2), ..., (1, 2), ...
+
+    Each block of block_size rows is computed as one vectorized strip of
+    distances to the points after it, and the blocks are spread over a pool
+    of threads (numpy releases the GIL while it works).  If filename is
+    given, the vector is written to a memory-mapped .npy file there instead
+    of being kept in memory, so only the strips in progress take any."""
+    points = asarray(data, dtype=float)
+    num_points = len(points)
+    size = num_points * (num_points - 1) // 2
+    if filename:
+        condensed = numpy.lib.format.open_memmap(filename, mode='w+',
+                dtype=float, shape=(size,))
+    else:
+        condensed = numpy.empty(size)
+    def fill(start):
+        end = min(start + block_size, num_points)
+        strip = minkowski_distances(points[start:end], points[start:], n)
+        for i in xrange(start, end):
+            # Where the distances from i to the points after it start.
+            offset = i * num_points - i * (i + 1) // 2
+            condensed[offset:offset+num_points-i-1] = strip[i-start,i-start+1:]
+    map_blocks(fill, num_points, block_size, threads)
+    if filename:
+        condensed.flush()
+    return condensed
+
+def map_blocks(fill, size, block_size, threads=None):
+    """Calls fill(start) for the start of each block of range(size), in a pool
+    of threads (None for one per core)."""
+    starts = range(0, size, block_size)
+    if threads == 1:
+        map(fill, starts)
+        return
+    pool = ThreadPool(threads)
+    pool.map(fill, starts)
+    pool.close()
+    pool.join()
+
 def make_binary_matrix(adj_matrix, d):
     new_matrix = zeros(adj_matrix.shape)
     len, wid = adj_matrix.shape
@@ -59,26 +115,150 @@ def make_binary_matrix(adj_matrix, d):
                 new_matrix[i,j] = 1
     return new_matrix
 
-def HAC(data, step, base=0, n=2):
-    adj_matrix = make_matrix(data, n)
-    d = base
-    k = len(data)
-    K = []
-    for datum in data:
+def HAC(data, step, base=0, n=2, linkage='single'):
+    """Hierarchical agglomerative clustering.  Returns a list of (d, k,
+    Cluster_Set) levels: first the n singleton clusters at distance base, and
+    then, for each d = base + m*step at which the number of clusters changes,
+    the k clusters left after every merge at a linkage distance of at most d.
+
+    linkage is 'single' (the closest pair of points between two clusters,
+    which gives the connected components of the graph of points within d of
+    each other), 'complete' (the farthest pair) or 'average' (the mean over
+    all pairs).  Single linkage is computed from a minimum spanning tree and
+    only needs O(n) memory; the others use the nearest-neighbor chain
+    algorithm on the full distance matrix.  Either way, each level's
+    Cluster_Set takes O(n) to build, so pick a step that doesn't make too
+    many levels."""
+    points = asarray(data, dtype=float)
+    if linkage == 'single':
+        merges = single_linkage_merges(points, n)
+    elif linkage in ('complete', 'average'):
+        merges = nn_chain_merges(points, n, linkage)
+    else:
+        raise ValueError('Unknown linkage: %s' % linkage)
+    merges.sort()
+
+    K = Cluster_Set()
+    for index, datum in enumerate(data):
         c = Cluster(datum)
-        K.append(c)
+        c.add(datum, index)
+        K.add_cluster(c)
     DE = []
-    DE.append((d, k, K))
-
-    while k != 1:
-        oldk = k
-        d = d + step
-        a = make_binary_matrix(adj_matrix, d)
-        k, newK = new_clusters(a, data)
-        if oldk != k:
-            DE.append((d, k, newK))
+    DE.append((base, len(data), K))
+
+    sets = Union_Find(len(data))
+    members = dict((i, [i]) for i in range(len(data)))
+    i = 0
+    while i < len(merges):
+        # The first step at or past this merge, like stepping d up from base.
+        m = max(1, int(numpy.ceil((merges[i][0] - base) / step)))
+        while base + m*step < merges[i][0]:
+            m += 1
+        d = base + m*step
+        while i < len(merges) and merges[i][0] <= d:
+            _, a, b = merges[i]
+            root_a, root_b = sets.find(a), sets.find(b)
+            root = sets.union(root_a, root_b)
+            other = root_b if root == root_a else root_a
+            members[root].extend(members.pop(other))
+            i += 1
+        K = Cluster_Set()
+        for root in sorted(members, key=lambda r: min(members[r])):
+            c = Cluster()
+            for index in members[root]:
+                c.add(data[index], index)
+            K.add_cluster(c)
+        DE.append((d, len(members), K))
     return DE
 
+def single_linkage_merges(points, n=2):
+    """Returns the single linkage merges, as (distance, i, j) tuples, from the
+    edges of a minimum spanning tree found with Prim's algorithm: a pass over
+    one vectorized row of distances per point."""
+    num_points = len(points)
+    in_tree = zeros(num_points, dtype=bool)
+    closest = numpy.empty(num_points)
+    closest.fill(numpy.inf)
+    nearest = zeros(num_points, dtype=int)
+    merges = []
+    j = 0
+    for step in xrange(num_points):
+        in_tree[j] = True
+        closest[j] = numpy.inf
+        dists = minkowski_distances(points, points[j:j+1], n)[:,0]
+        closer = (dists < closest) & ~in_tree
+        closest[closer] = dists[closer]
+        nearest[closer] = j
+        if step == num_points - 1:
+            break
+        j = int(closest.argmin())
+        merges.append((float(closest[j]), int(nearest[j]), j))
+    return merges
+
+def nn_chain_merges(points, n=2, linkage='complete'):
+    """Returns the complete or average linkage merges, as (distance, i, j)
+    tuples, found with the nearest-neighbor chain algorithm.  Merged clusters
+    have their distances updated with the Lance-Williams formulas, a row at a
+    time."""
+    dists = make_matrix(points, n)
+    num_points = len(dists)
+    numpy.fill_diagonal(dists, numpy.inf)
+    sizes = numpy.ones(num_points)
+    active = numpy.ones(num_points, dtype=bool)
+    merges = []
+    chain = []
+    while len(merges) < num_points - 1:
+        if not chain:
+            chain.append(int(numpy.flatnonzero(active)[0]))
+        a = chain[-1]
+        b = int(dists[a].argmin())
+        if len(chain) > 1 and dists[a,chain[-2]] <= dists[a,b]:
+            b = chain[-2]
+        if len(chain) == 1 or b != chain[-2]:
+            chain.append(b)
+            continue
+        # a and b are each other's nearest neighbors, so they get merged, into
+        # b's row.
+        chain = chain[:-2]
+        merges.append((float(dists[a,b]), a, b))
+        if linkage == 'complete':
+            merged = numpy.maximum(dists[a], dists[b])
+        else:
+            merged = ((sizes[a] * dists[a] + sizes[b] * dists[b]) /
+                    (sizes[a] + sizes[b]))
+        merged[b] = numpy.inf
+        dists[b] = merged
+        dists[:,b] = merged
+        dists[a] = numpy.inf
+        dists[:,a] = numpy.inf
+        sizes[b] += sizes[a]
+        active[a] = False
+    return merges
+
+class Union_Find:
+    def __init__(self, size):
+        self.parents = range(size)
+        self.sizes = [1,]*size
+
+    def find(self, i):
+        parents = self.parents
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def union(self, i, j):
+        """Joins the sets containing i and j, and returns the new root."""
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return i
+        if self.sizes[i] < self.sizes[j]:
+            i, j = j, i
+        self.parents[j] = i
+        self.sizes[i] += self.sizes[j]
+        return i
+
 def new_clusters(adj_matrix, data):
     K = Cluster_Set()
     width, height = adj_matrix.shape
@@ -104,41 +284,276 @@ def new_clusters(adj_matrix, data):
                 c.add(data[j], j)
     return K.num_clusters(), K
 
-def k_means_best_k(data, normval=2):
-    minerror = 10000000
+def k_means_best_k(data, normval=2, restarts=1, init='first', seed=None,
+        processes=1, algorithm='lloyd'):
+    """Runs k_means for k from 2 to 7, restarts times each, and returns the
+    k, error and clusters of the run with the lowest error.  Restarts only
+    make sense with a random init ('k-means++').  With processes other than
+    1, the runs are spread across a pool of that many worker processes (None
+    means one per core)."""
+    points = asarray(data, dtype=float)
+    jobs = []
+    seeds = numpy.random.RandomState(seed).randint(2**31, size=6 * restarts)
+    for i in range(2,8):
+        for restart in range(restarts):
+            jobs.append((i, normval, init, seeds[len(jobs)], algorithm))
+    if processes == 1:
+        results = [_run_k_means(points, job) for job in jobs]
+    else:
+        pool = Pool(processes, _init_k_means_worker, (points,))
+        results = pool.map(_k_means_job, jobs)
+        pool.close()
+        pool.join()
+    minerror = float('inf')
     bestk = 0
     bestclusters = None
     for i in range(2,8):
-        clusters, error = k_means(data, i, normval)
+        k_results = [r for r in results if r[0] == i]
+        _, labels, means, error = min(k_results, key=lambda r: r[3])
         if error < minerror:
-            bestclusters = clusters
+            bestclusters = make_cluster_set(data, labels, means)
             minerror = error
             bestk = i
         print i, error
     return bestk, minerror, bestclusters
 
-def k_means(data, k, normval=2):
-    means = []
+# Set in each k_means_best_k worker, so the data is only sent once per worker
+# instead of once per run.
+_k_means_points = None
+
+def _init_k_means_worker(points):
+    global _k_means_points
+    _k_means_points = points
+
+def _k_means_job(job):
+    return _run_k_means(_k_means_points, job)
+
+def _run_k_means(points, job):
+    k, normval, init, seed, algorithm = job
+    means = initial_means(points, k, normval, init, seed)
+    labels, means = K_MEANS_ALGORITHMS[algorithm](points, means, normval)
+    return k, labels, means, cluster_error(points, labels, means)
+
+def k_means(data, k, normval=2, init='first', seed=None, algorithm='lloyd',
+        max_iterations=None):
+    """Runs k-means until the means stop changing (or for max_iterations).
+    data can be a list of points or an (n, d) array.  Returns the clusters as
+    a Cluster_Set, and their error.
+
+    init picks the starting means: 'first' uses the first k data points, and
+    'k-means++' samples them with k-means++ seeding (seeded with seed).
+    algorithm is 'lloyd', which computes every point-to-mean distance in
+    every iteration, or 'hamerly', which gets the same clusters while
+    skipping most of those distances after the first iteration; it is much
+    faster when k is large."""
+    points = asarray(data, dtype=float)
+    means = initial_means(points, k, normval, init, seed)
+    labels, means = K_MEANS_ALGORITHMS[algorithm](points, means, normval,
+            max_iterations)
+    return (make_cluster_set(data, labels, means),
+            cluster_error(points, labels, means))
+
+def lloyd(points, means, normval=2, max_iterations=None):
+    """Lloyd's iterations from the given means until they stop changing;
+    returns the final labels and means.
+
+    Each iteration is a handful of vectorized operations over the whole data
+    set: one batch of point-to-mean distances, and a bincount per dimension to
+    get the new means."""
+    iteration = 0
+    while True:
+        labels = closest_means(points, means, normval)
+        new_means = compute_means(points, labels, means)
+        iteration += 1
+        if (numpy.array_equal(new_means, means) or
+                iteration == max_iterations):
+            return labels, means
+        means = new_means
+
+def hamerly(points, means, normval=2, max_iterations=None):
+    """The same iterations as lloyd, with Hamerly's (2010) bounds to skip
+    distance computations.  Each point keeps an upper bound on the distance
+    to its mean and a lower bound on the distance to every other mean.  By
+    the triangle inequality, while the upper bound is below both the lower
+    bound and half the distance from its mean to the closest other mean, the
+    point can't change clusters, so nothing is computed for it.  When the
+    means move, the bounds are loosened by how far they moved.
+
+    The points that do need checking, and the distances between means, are
+    looked up in a KD-tree over the means instead of against every mean.
+    This needs a metric, so normval has to be at least 1."""
+    from scipy.spatial import cKDTree
+    if normval < 1:
+        raise ValueError('Hamerly k-means needs normval >= 1')
+    tree = cKDTree(means)
+    labels, upper, lower = closest_two_means_in_tree(tree, points, normval)
+    iteration = 0
+    while True:
+        half_gaps = tree.query(means, k=2, p=normval)[0][:,1] / 2
+        bounds = numpy.maximum(half_gaps[labels], lower)
+        check = numpy.flatnonzero(upper > bounds)
+        upper[check] = paired_distances(points[check], means[labels[check]],
+                normval)
+        check = check[upper[check] > bounds[check]]
+        if len(check):
+            labels[check], upper[check], lower[check] = (
+                    closest_two_means_in_tree(tree, points[check], normval))
+        new_means = compute_means(points, labels, means)
+        iteration += 1
+        if (numpy.array_equal(new_means, means) or
+                iteration == max_iterations):
+            return labels, means
+        shifts = paired_distances(means, new_means, normval)
+        means = new_means
+        tree = cKDTree(means)
+        upper += shifts[labels]
+        # Every other mean moved by at most the largest shift, except for the
+        # mean that moved the most, whose own points only need the second
+        # largest.
+        biggest = shifts.argmax()
+        largest = shifts[biggest]
+        shifts[biggest] = 0
+        lower -= numpy.where(labels == biggest, shifts.max(), largest)
+
+def closest_two_means_in_tree(tree, points, normval=2):
+    """Returns the index of the closest mean in the KD-tree to each point, the
+    distance to it, and the distance to the second closest mean."""
+    dists, indices = tree.query(points, k=2, p=normval)
+    return indices[:,0], dists[:,0], dists[:,1]
+
+K_MEANS_ALGORITHMS = {'lloyd': lloyd, 'hamerly': hamerly}
+
+def paired_distances(X, Y, n=2):
+    """Returns norm(X[i], Y[i], n) for each row i."""
+    return (abs(X - Y)**n).sum(axis=1)**(1/n)
+
+def initial_means(points, k, normval=2, init='first', seed=None):
+    if init == 'first':
+        return points[:k].copy()
+    if init != 'k-means++':
+        raise ValueError('Unknown k-means init: %s' % init)
+    # k-means++: each new mean is a data point, picked with probability
+    # proportional to its squared distance from the closest mean so far.
+    random = numpy.random.RandomState(seed)
+    means = zeros((k, points.shape[1]))
+    means[0] = points[random.randint(len(points))]
+    closest = minkowski_distances(points, means[:1], normval)[:,0]**2
+    for i in xrange(1, k):
+        total = closest.sum()
+        if total > 0:
+            choice = numpy.searchsorted(closest.cumsum(),
+                    random.uniform(0, total), side='right')
+            choice = min(choice, len(points) - 1)
+        else:
+            choice = random.randint(len(points))
+        means[i] = points[choice]
+        dists = minkowski_distances(points, means[i:i+1], normval)[:,0]**2
+        closest = numpy.minimum(closest, dists)
+    return means
+
+def mini_batch_k_means(data, k, normval=2, batch_size=1000, iterations=100,
+        init='k-means++', seed=None, cluster_set=True):
+    """Mini-batch k-means (Sculley, 2010), for data sets too big to run full
+    k-means iterations over.  data can be an array on disk (a numpy memmap);
+    each iteration only reads batch_size random points from it.  Each mean
+    is the running average of all of the batch points assigned to it so far.
+    Returns the same things as k_means, with every point assigned to its
+    closest final mean.
+
+    An array is never copied (or converted to floats) as a whole: the final
+    labels and the error are also computed a block of points at a time.  The
+    Cluster_Set holds every point in lists, though, so for data that doesn't
+    fit in memory pass cluster_set=False to get the labels (an array), means
+    and error instead."""
+    if isinstance(data, numpy.ndarray):
+        points = data
+    else:
+        points = asarray(data, dtype=float)
+    random = numpy.random.RandomState(seed)
+    sample_size = min(len(points), max(batch_size, 3 * k))
+    sample = numpy.sort(random.choice(len(points), sample_size, replace=False))
+    means = initial_means(asarray(points[sample], dtype=float), k, normval,
+            init, random.randint(2**31))
+    seen = zeros(k)
+    for iteration in xrange(iterations):
+        batch = numpy.sort(random.randint(len(points), size=batch_size))
+        batch = asarray(points[batch], dtype=float)
+        labels = closest_means(batch, means, normval)
+        sizes = numpy.bincount(labels, minlength=k)
+        sums = zeros(means.shape)
+        for i in xrange(points.shape[1]):
+            sums[:,i] = numpy.bincount(labels, weights=batch[:,i], minlength=k)
+        updated = sizes > 0
+        means[updated] = ((seen[updated,None] * means[updated] + sums[updated])
+                / (seen[updated] + sizes[updated])[:,None])
+        seen += sizes
+    labels = closest_means(points, means, normval)
+    error = cluster_error(points, labels, means)
+    if not cluster_set:
+        return labels, means, error
+    return make_cluster_set(data, labels, means), error
+
+def closest_means(points, means, normval=2):
+    """Returns the index of the closest mean to each point, breaking ties in
+    favor of the lower index.  Distances are computed in blocks of points, so
+    that we never hold more than a few million of them at once."""
+    labels = numpy.empty(len(points), dtype=int)
+    block = _block_size(max(len(means), points.shape[1]))
+    for start in xrange(0, len(points), block):
+        dists = minkowski_distances(points[start:start+block], means, normval)
+        labels[start:start+block] = dists.argmin(axis=1)
+    return labels
+
+def compute_means(points, labels, means):
+    """Returns the mean of the points with each label.  A mean with no points
+    left stays where it was."""
+    k = len(means)
+    sizes = numpy.bincount(labels, minlength=k)
+    sums = zeros(means.shape)
+    for i in xrange(points.shape[1]):
+        sums[:,i] = numpy.bincount(labels, weights=points[:,i], minlength=k)
+    new_means = means.copy()
+    nonempty = sizes > 0
+    new_means[nonempty] = sums[nonempty] / sizes[nonempty,None]
+    return new_means
+
+def cluster_error(points, labels, means):
+    """Cluster_Set.error, for points assigned to means by labels, computed a
+    block of points at a time like closest_means."""
+    error = 0
+    block = _block_size(points.shape[1])
+    for start in xrange(0, len(points), block):
+        diffs = (asarray(points[start:start+block], dtype=float) -
+                means[labels[start:start+block]])
+        error += numpy.sqrt((diffs**2).sum(axis=1)).sum()
+    return error
+
+def _block_size(width):
+    """How many rows of points to work on at once, when each one takes width
+    values, to stay at a few million values."""
+    return max(1, 2**22 // max(1, width))
+
+def make_cluster_set(data, labels, means):
+    """Builds a (finished) Cluster_Set out of the label of each data point
+    and the means."""
     K = Cluster_Set()
-    for i in xrange(k):
-        K.add_cluster(Cluster(data[i]))
-
-    clusters = K.clusters
-    while not K.is_finished():
-        for i in xrange(k):
-            clusters[i].reset()
-        for index, datum in enumerate(data):
-            closest = 0
-            dist = norm(datum, clusters[closest].mean, normval)
-            for i in range(len(clusters)):
-                if (norm(datum, clusters[i].mean, normval) < dist):
-                    dist = norm(datum, clusters[i].mean, normval)
-                    closest = i
-            clusters[closest].add(datum, index)
-        K.compute_means()
-    return K, K.error()
+    for mean in means:
+        c = Cluster()
+        c.mean = mean.tolist()
+        c.oldmean = c.mean
+        K.add_cluster(c)
+    for index, label in enumerate(labels.tolist()):
+        K.clusters[label].add(data[index], index)
+    return K
 
 class Cluster:
+    """A cluster of data points, each known by its index in the data.
+
+    Besides the data and indices lists, a cluster keeps the position of each
+    index in them, so index checks and removals are O(1).  A count of each
+    data item, for item checks, is only built on the first contains_item and
+    kept up to date after that.  A cluster can belong to one Cluster_Set (its
+    owner), which is kept up to date as points are added and removed."""
     def __init__(self, datum=None):
         self.oldmean = []
         self.mean = []
@@ -147,57 +562,89 @@ class Cluster:
             self.mean = datum
         self.data = []
         self.indices = []
+        self.positions = {}
+        self.items = None
+        self.owner = None
 
     def add(self, datum, index):
+        self.positions[index] = len(self.indices)
         self.data.append(datum)
         self.indices.append(index)
+        if self.items is not None:
+            key = item_key(datum)
+            self.items[key] = self.items.get(key, 0) + 1
+        if self.owner is not None:
+            self.owner.assignment[index] = self
+
+    def remove(self, index):
+        """Removes the point with the given index, and returns its datum.  The
+        last point is moved into its place, so the order of the points
+        changes."""
+        position = self.positions.pop(index)
+        datum = self.data[position]
+        last_datum = self.data.pop()
+        last_index = self.indices.pop()
+        if last_index != index:
+            self.data[position] = last_datum
+            self.indices[position] = last_index
+            self.positions[last_index] = position
+        if self.items is not None:
+            key = item_key(datum)
+            self.items[key] -= 1
+            if self.items[key] == 0:
+                del self.items[key]
+        if self.owner is not None:
+            self.owner.unassign(index, self)
+        return datum
 
     def reset(self):
+        if self.owner is not None:
+            for index in self.indices:
+                self.owner.unassign(index, self)
         self.data = []
         self.indices = []
+        self.positions = {}
+        self.items = None
 
     def compute_mean(self):
         self.oldmean = self.mean
-        dims = len(self.mean)
-        if dims == 0:
-            dims = len(self.data[0])
-        sum = [0,]*dims
-        for datum in self.data:
-            for i in range(dims):
-                sum[i] += datum [i]
-        for i in range(dims):
-            sum[i] = sum[i]/len(self.data)
-        self.mean = sum
+        self.mean = asarray(self.data, dtype=float).mean(axis=0).tolist()
 
     def is_finished(self):
         return self.oldmean == self.mean
 
     def error(self):
-        e = 0
+        if len(self.data) == 0:
+            return 0
         if len(self.mean) == 0:
             self.compute_mean()
-        for datum in self.data:
-            e += norm(datum, self.mean)
-        return e
+        diffs = asarray(self.data, dtype=float) - self.mean
+        return numpy.sqrt((diffs**2).sum(axis=1)).sum()
 
     def contains_item(self, item):
-        for dautm in self.data:
-            if datum == item:
-                return True
-        return False
+        if self.items is None:
+            self.items = {}
+            for datum in self.data:
+                key = item_key(datum)
+                self.items[key] = self.items.get(key, 0) + 1
+        return item_key(item) in self.items
 
     def contains_index(self, i):
-        for index in self.indices:
-            if i == index:
-                return True
-        return False
+        return i in self.positions
 
     def sort_indices(self):
-        self.indices.sort()
+        order = sorted(range(len(self.indices)), key=self.indices.__getitem__)
+        self.data = [self.data[i] for i in order]
+        self.indices = [self.indices[i] for i in order]
+        self.positions = dict((index, i) for i, index in
+                enumerate(self.indices))
 
 class Cluster_Set:
+    """A list of clusters, plus an assignment of each point index to the
+    cluster holding it, so finding a point's cluster is O(1)."""
     def __init__(self):
         self.clusters = []
+        self.assignment = {}
 
     def __iter__(self):
         return iter(self.clusters)
@@ -206,8 +653,33 @@ class Cluster_Set:
         return len(self.clusters)
 
     def add_cluster(self, c):
+        c.owner = self
+        for index in c.indices:
+            self.assignment[index] = c
         self.clusters.append(c)
 
+    def unassign(self, index, c):
+        if self.assignment.get(index, None) is c:
+            del self.assignment[index]
+
+    def move(self, index, c):
+        """Moves the point with the given index into cluster c."""
+        datum = self.assignment[index].remove(index)
+        c.add(datum, index)
+
+    def merge(self, c1, c2):
+        """Merges two clusters of this set, by moving the points of the
+        smaller one into the larger one, which is returned.  The emptied
+        cluster is removed from the set."""
+        if len(c1.indices) < len(c2.indices):
+            c1, c2 = c2, c1
+        for index, datum in zip(c2.indices, c2.data):
+            c1.add(datum, index)
+        c2.owner = None
+        c2.reset()
+        self.clusters.remove(c2)
+        return c1
+
     def contains_item(self, item):
         for c in self.clusters:
             if c.contains_item(item):
@@ -215,10 +687,10 @@ class Cluster_Set:
         return False, []
 
     def contains_index(self, i):
-        for c in self.clusters:
-            if c.contains_index(i):
-                return True, c
-        return False, []
+        c = self.assignment.get(i, None)
+        if c is None:
+            return False, []
+        return True, c
 
     def get_cluster(self, i):
         return self.clusters[i]
@@ -243,7 +715,19 @@ class Cluster_Set:
         return error
 
     def remove_cluster(self):
-        self.clusters = self.clusters[:-1]
+        if not self.clusters:
+            return
+        c = self.clusters.pop()
+        for index in c.indices:
+            self.unassign(index, c)
+        c.owner = None
+
+def item_key(item):
+    """Data points are usually lists, so they are counted by their tuple."""
+    try:
+        return tuple(item)
+    except TypeError:
+        return item
 
 def norm(x, y, n=2):
     sum = 0
@@ -251,20 +735,133 @@ def norm(x, y, n=2):
         sum += abs(x[i] - y[i])**n
     return sum**(1/n)
 
+def minkowski_distances(X, Y, n=2):
+    """Returns the matrix of norm(x, y, n) for every row x of X and row y of
+    Y, computed with array operations.  Every distance comes from the
+    differences of the coordinates: expanding |x-y|^2 into |x|^2 - 2 x.y +
+    |y|^2 is faster, but it rounds nearby points far from the origin to a
+    distance of 0."""
+    from scipy.spatial.distance import cdist
+    X = asarray(X, dtype=float)
+    Y = asarray(Y, dtype=float)
+    if n == 2:
+        return cdist(X, Y, 'euclidean')
+    if n == 1:
+        return cdist(X, Y, 'cityblock')
+    # One dimension at a time, so we never make an (len(X), len(Y), d) array.
+    dists = zeros((len(X), len(Y)))
+    for i in xrange(X.shape[1]):
+        dists += abs(X[:,i,None] - Y[None,:,i])**n
+    return dists**(1/n)
+
 def read_data(filename):
     file = open(filename, 'rU')
     numvars = int(file.readline())
     names = file.readline()[:-1].split(',')
-    lines = file.readlines()
     data = []
     labels = []
-    for str in lines:
+    for str in file:
         if str.endswith('\n'):
             str = str[:-1]
-        data.append(map(float, str.split(',')[:-1]))
-        labels.append(str.split(',')[-1])
+        fields = str.split(',')
+        data.append(map(float, fields[:-1]))
+        labels.append(fields[-1])
+    file.close()
+    return numvars, names, data, labels
+
+def read_data_array(filename, chunk_size=65536, cache=True):
+    """Like read_data, but returns the data as an (n, d) float array and the
+    labels as an array of strings.  The file is read chunk_size lines at a
+    time, and numpy parses all of the numbers in a chunk in one call.
+
+    If cache is True, the arrays are also saved next to the file, as
+    filename.data.npy and filename.labels.npy.  As long as those are newer
+    than the file, later calls memory-map them instead of parsing the text
+    again.  Each cache file is written under a temporary name and renamed into
+    place, so an interrupted save never leaves a truncated one behind.
+
+    Every line has to have as many fields as the first data line; otherwise
+    (or if a value isn't a number) we raise a ValueError with its line
+    number."""
+    file = open(filename, 'rU')
+    numvars = int(file.readline())
+    names = file.readline()[:-1].split(',')
+    data_filename = filename + '.data.npy'
+    labels_filename = filename + '.labels.npy'
+    if cache and is_newer(data_filename, filename) and is_newer(
+            labels_filename, filename):
+        file.close()
+        return (numvars, names, numpy.load(data_filename, mmap_mode='r'),
+                numpy.load(labels_filename, mmap_mode='r'))
+    chunks = []
+    labels = []
+    num_fields = None
+    line_number = 2
+    while True:
+        lines = list(islice(file, chunk_size))
+        if not lines:
+            break
+        values = []
+        numbers = []
+        for line in lines:
+            line_number += 1
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            fields = line.count(',') + 1
+            if num_fields is None:
+                num_fields = fields
+            elif fields != num_fields:
+                file.close()
+                raise ValueError('%s, line %d: expected %d fields, got %d' %
+                        (filename, line_number, num_fields, fields))
+            value, _, label = line.rpartition(',')
+            values.append(value)
+            numbers.append(line_number)
+            labels.append(label)
+        if values:
+            chunk = numpy.fromstring(','.join(values), sep=',')
+            if chunk.size != len(values) * (num_fields - 1):
+                file.close()
+                _raise_bad_value(filename, values, numbers)
+            chunks.append(chunk.reshape(len(values), num_fields - 1))
+    file.close()
+    if chunks:
+        data = numpy.concatenate(chunks)
+    else:
+        data = zeros((0, max(0, len(names) - 1)))
+    labels = array(labels)
+    if cache:
+        _save_atomically(data_filename, data)
+        _save_atomically(labels_filename, labels)
     return numvars, names, data, labels
 
+def _raise_bad_value(filename, values, numbers):
+    """numpy.fromstring stops at the first value it can't parse, so we find
+    the line it was on one line at a time."""
+    for value, line_number in zip(values, numbers):
+        for field in value.split(','):
+            try:
+                float(field)
+            except ValueError:
+                raise ValueError('%s, line %d: not a number: %r' % (filename,
+                    line_number, field))
+    raise ValueError('%s: could not parse lines %d to %d' % (filename,
+        numbers[0], numbers[-1]))
+
+def _save_atomically(filename, array):
+    temp_filename = filename + '.tmp'
+    f = open(temp_filename, 'wb')
+    try:
+        numpy.save(f, array)
+    finally:
+        f.close()
+    os.rename(temp_filename, filename)
+
+def is_newer(filename, than):
+    return (os.path.exists(filename) and
+            os.path.getmtime(filename) >= os.path.getmtime(than))
+
 if __name__ == '__main__':
     main()
 
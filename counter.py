@@ -1,7 +1,40 @@
 #!/usr/bin/env python
 
 from __future__ import division
-from heapq import heappush, heappop
+from cStringIO import StringIO
+from heapq import heapify, heappush, heappop, nlargest
+from multiprocessing import Pool
+from multiprocessing.managers import BaseManager
+import mmap
+import os
+import struct
+import threading
+import zlib
+import numpy
+
+# Binary index files (see Index.save_to_binary_file) start with this, followed
+# by the number of strings, the size of the hash table and whether the strings
+# were unicode.
+BINARY_INDEX_MAGIC = 'PUIDX002'
+BINARY_INDEX_HEADER = '<8sQQQ'
+
+# Counter and CounterMap snapshots (see save_snapshot) start with these,
+# followed by a sequence of arrays in numpy's .npy format.
+COUNTER_SNAPSHOT_MAGIC = 'PUCNT002'
+COUNTER_MAP_SNAPSHOT_MAGIC = 'PUCMS002'
+
+# A CounterMapLog starts with this and its generation.  Each record in it
+# starts with the length of the snapshot that follows it and the position it
+# was appended with.
+COUNTER_MAP_LOG_MAGIC = 'PUCML001'
+COUNTER_MAP_LOG_HEADER = '<8sq'
+COUNTER_MAP_LOG_RECORD = '<Qq'
+
+# A CounterMapLog's snapshot starts with this, the generation of the log it
+# covers, how many bytes of it, whether there is a position and the position,
+# followed by a CounterMap snapshot.
+COUNTER_MAP_LOG_SNAPSHOT_MAGIC = 'PUCLS001'
+COUNTER_MAP_LOG_SNAPSHOT_HEADER = '<8sqQ?q'
 
 class Index(object):
     def __init__(self):
@@ -14,13 +47,27 @@ class Index(object):
     def getIndex(self, string, _force_add=False):
         if not _force_add:
             index = self.strings.get(string, None)
-            if index:
+            if index is not None:
                 return index
         self.strings[string] = self.current_index
         self.array.append(string)
         self.current_index += 1
         return self.current_index - 1
 
+    def getIndices(self, strings):
+        """Returns a list with getIndex(string) for each of the strings, with
+        the method lookups done once for the whole batch instead of once per
+        string."""
+        get = self.strings.get
+        indices = []
+        append = indices.append
+        for string in strings:
+            index = get(string, None)
+            if index is None:
+                index = self.getIndex(string, _force_add=True)
+            append(index)
+        return indices
+
     def getString(self, index):
         return self.array[index]
 
@@ -48,6 +95,298 @@ class Index(object):
             index.getIndex(string, _force_add=True)
         return index
 
+    def save_to_binary_file(self, filename):
+        """Writes the index in a binary format that can be opened with
+        MappedIndex, or read back with read_from_binary_file.
+
+        After the header comes a table of string offsets (n+1 little-endian
+        uint64s), then an open-addressing hash table (uint32 indices, 0 for an
+        empty slot, probed linearly from crc32(string)), then the strings
+        themselves, utf-8 encoded.  Unicode strings are read back as unicode;
+        see _encode_strings."""
+        strings, is_unicode = _encode_strings(self.getAllStrings())
+        num_strings = len(strings)
+        offsets = numpy.zeros(num_strings + 1, dtype='<u8')
+        numpy.cumsum([len(string) for string in strings], out=offsets[1:])
+        table_size = 2
+        while table_size < 2 * num_strings:
+            table_size *= 2
+        mask = table_size - 1
+        table = numpy.zeros(table_size, dtype='<u4')
+        slots = numpy.array([_hash(string) for string in strings],
+                dtype=numpy.int64) & mask
+        # Linear probing, one probe step at a time for all of the strings that
+        # haven't found an empty slot yet.  When several want the same slot,
+        # the one that comes first in the index gets it.
+        pending = numpy.arange(num_strings)
+        while len(pending):
+            wanted = slots[pending]
+            free = table[wanted] == 0
+            taken, first = numpy.unique(wanted[free], return_index=True)
+            winners = pending[free][first]
+            table[taken] = winners + 1
+            placed = numpy.zeros(num_strings, dtype=bool)
+            placed[winners] = True
+            pending = pending[~placed[pending]]
+            slots[pending] = (slots[pending] + 1) & mask
+        f = open(filename, 'wb')
+        f.write(struct.pack(BINARY_INDEX_HEADER, BINARY_INDEX_MAGIC,
+            num_strings, table_size, is_unicode))
+        f.write(offsets.tostring())
+        f.write(table.tostring())
+        f.write(''.join(strings))
+        f.close()
+
+    @classmethod
+    def read_from_binary_file(cls, filename):
+        """Loads a file written by save_to_binary_file into a regular,
+        modifiable index."""
+        mapped = MappedIndex(filename)
+        index = cls()
+        index.array.extend(mapped.getAllStrings())
+        index.strings = dict(zip(index.array[1:], xrange(1, mapped.size + 1)))
+        index.current_index = mapped.size + 1
+        return index
+
+
+class LockedIndex(Index):
+    """An Index that can be shared between threads.
+
+    Strings already in the index are looked up without taking the lock, so
+    only adding a new string pays for it, and getIndices takes the lock once
+    for the whole batch.  (With the GIL there is nothing to gain from
+    striping the lock.)  To share an index between processes, see
+    shared_index."""
+    def __init__(self):
+        super(LockedIndex, self).__init__()
+        self.lock = threading.Lock()
+
+    def getIndex(self, string, _force_add=False):
+        if not _force_add:
+            index = self.strings.get(string, None)
+            if index is not None:
+                return index
+        with self.lock:
+            return self._add(string, _force_add)
+
+    def getIndices(self, strings):
+        strings = list(strings)
+        get = self.strings.get
+        indices = []
+        missing = []
+        for i, string in enumerate(strings):
+            index = get(string, None)
+            if index is None:
+                missing.append(i)
+            indices.append(index)
+        if missing:
+            with self.lock:
+                for i in missing:
+                    indices[i] = self._add(strings[i], False)
+        return indices
+
+    def _add(self, string, force_add):
+        # Another thread may have added the string since we last looked.
+        if not force_add:
+            index = self.strings.get(string, None)
+            if index is not None:
+                return index
+        index = self.current_index
+        # Lock-free readers find the string through self.strings, so it
+        # has to be in self.array before it goes in there.
+        self.array.append(string)
+        self.current_index += 1
+        self.strings[string] = index
+        return index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+class IndexManager(BaseManager):
+    pass
+
+IndexManager.register('LockedIndex', LockedIndex)
+
+
+def shared_index():
+    """Starts a server process holding a LockedIndex and returns a proxy to
+    it, along with the IndexManager running the server; call its shutdown()
+    when you are done with the index.  The proxy can be passed to
+    multiprocessing workers, and every process gets the same index for the
+    same string.  Each call on the proxy is a round trip to the server, so
+    use getIndices to intern strings in batches."""
+    manager = IndexManager()
+    manager.start()
+    return manager.LockedIndex(), manager
+
+
+class MappedIndex(object):
+    """A read-only Index over a file written by Index.save_to_binary_file.
+
+    The file is mmapped, so opening it takes constant time no matter how big
+    the vocabulary is, strings are only read when they are asked for, and
+    processes that open the same file share its pages.  Because the index
+    can't change, getIndex raises a KeyError for strings it doesn't have
+    instead of adding them."""
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        magic, size, table_size, is_unicode = struct.unpack_from(
+                BINARY_INDEX_HEADER, self.mmap)
+        if magic != BINARY_INDEX_MAGIC:
+            raise ValueError('%s is not a binary index file' % filename)
+        self.is_unicode = bool(is_unicode)
+        self.size = size
+        self.current_index = size + 1
+        start = struct.calcsize(BINARY_INDEX_HEADER)
+        self.offsets = numpy.frombuffer(self.mmap, dtype='<u8',
+                count=size + 1, offset=start)
+        start += self.offsets.nbytes
+        self.table = numpy.frombuffer(self.mmap, dtype='<u4',
+                count=table_size, offset=start)
+        self.strings_start = start + self.table.nbytes
+        self.mask = table_size - 1
+
+    def getIndex(self, string):
+        string = _encode(string)
+        slot = _hash(string) & self.mask
+        while True:
+            index = int(self.table[slot])
+            if index == 0:
+                raise KeyError(string)
+            if self._get(index) == string:
+                return index
+            slot = (slot + 1) & self.mask
+
+    def getIndices(self, strings):
+        return [self.getIndex(string) for string in strings]
+
+    def getString(self, index):
+        if not 0 < index <= self.size:
+            raise IndexError(index)
+        string = self._get(index)
+        if self.is_unicode:
+            return string.decode('utf-8')
+        return string
+
+    def _get(self, index):
+        """The encoded string for index, as stored in the file."""
+        start = self.strings_start + int(self.offsets[index - 1])
+        end = self.strings_start + int(self.offsets[index])
+        return self.mmap[start:end]
+
+    def getAllStrings(self):
+        data = self.mmap[self.strings_start:]
+        offsets = self.offsets.tolist()
+        strings = [data[offsets[i]:offsets[i + 1]] for i in xrange(self.size)]
+        return _decode_strings(strings, self.is_unicode)
+
+    def close(self):
+        self.offsets = None
+        self.table = None
+        self.mmap.close()
+
+
+def _save_counter_snapshot(counter, f):
+    f, close = _open(f, 'wb')
+    items = counter.items()
+    f.write(COUNTER_SNAPSHOT_MAGIC)
+    _save_strings(f, [key for key, _ in items])
+    numpy.save(f, numpy.array([count for _, count in items]))
+    if close:
+        f.close()
+
+
+def _read_counter_snapshot(cls, f):
+    f, close = _open(f, 'rb')
+    _check_magic(f, COUNTER_SNAPSHOT_MAGIC)
+    keys = _read_strings(f)
+    counts = numpy.load(f).tolist()
+    if close:
+        f.close()
+    counter = cls()
+    counter.incrementCounts(keys, counts)
+    return counter
+
+
+def _save_strings(f, strings):
+    strings, is_unicode = _encode_strings(strings)
+    numpy.save(f, numpy.array(is_unicode))
+    offsets = numpy.zeros(len(strings) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(string) for string in strings], out=offsets[1:])
+    numpy.save(f, offsets)
+    # numpy.frombuffer doesn't take an empty buffer; the extra byte is past
+    # the last offset, so it's never read back.
+    numpy.save(f, numpy.frombuffer(''.join(strings) or '\0', dtype=numpy.uint8))
+
+
+def _read_strings(f):
+    is_unicode = bool(numpy.load(f))
+    offsets = numpy.load(f).tolist()
+    data = numpy.load(f).tostring()
+    return _decode_strings([data[offsets[i]:offsets[i + 1]] for i in
+        xrange(len(offsets) - 1)], is_unicode)
+
+
+def _open(f, mode):
+    """Returns f opened with mode if it's a filename, and whether the caller
+    needs to close it."""
+    if isinstance(f, basestring):
+        return open(f, mode), True
+    return f, False
+
+
+def _check_magic(f, magic):
+    if f.read(len(magic)) != magic:
+        raise ValueError('Not a %s snapshot' % magic)
+
+
+def _encode_strings(strings):
+    """utf-8 encodes strings for writing to a file, and returns them along
+    with whether they should be decoded again when they are read back.
+
+    They are, if any of the strings is unicode.  Then any byte strings have
+    to be ASCII, which Python 2 treats as equal to the same unicode strings;
+    other byte strings would come back as different strings, so they raise a
+    ValueError."""
+    is_unicode = any(isinstance(string, unicode) for string in strings)
+    encoded = []
+    for string in strings:
+        if isinstance(string, unicode):
+            string = string.encode('utf-8')
+        elif is_unicode:
+            try:
+                string.decode('ascii')
+            except UnicodeDecodeError:
+                raise ValueError("Can't save a mix of unicode and non-ASCII "
+                        "byte strings: %r" % string)
+        encoded.append(string)
+    return encoded, is_unicode
+
+
+def _decode_strings(strings, is_unicode):
+    if is_unicode:
+        return [string.decode('utf-8') for string in strings]
+    return strings
+
+
+def _encode(string):
+    if isinstance(string, unicode):
+        return string.encode('utf-8')
+    return string
+
+
+def _hash(string):
+    return zlib.crc32(string) & 0xffffffff
+
 # A Counter class.  Basically it's a map with some convenient features.  It's
 # based off of a java class written by Dan Klein for the Berkeley NLP group.  I
 # didn't implement everything he did - I might later.  Add things as needed.
@@ -55,10 +394,19 @@ class Index(object):
 class Counter:
     def __init__(self):
         self.entries = dict()
+        # The running total is kept up to date by setCount and
+        # incrementCount, so don't modify self.entries directly.  If the
+        # counter is a row of a CounterMap, parent is that CounterMap, whose
+        # totals get updated too.
+        self.total = 0
+        self.parent = None
 
     def keySet(self):
         return self.entries.keys()
 
+    def items(self):
+        return self.entries.items()
+
     def size(self):
         return len(self.entries)
 
@@ -75,51 +423,434 @@ class Counter:
             return self.entries[key]
 
     def setCount(self, key, count):
+        if key in self.entries:
+            self._update_total(count - self.entries[key], 0)
+        else:
+            self._update_total(count, 1)
         self.entries[key] = count
 
     def incrementCount(self, key, inc):
         if key in self.entries:
             self.entries[key] += inc
+            self._update_total(inc, 0)
         else:
             self.entries[key] = inc
+            self._update_total(inc, 1)
+
+    def _update_total(self, delta, new_keys):
+        self.total += delta
+        if self.parent is not None:
+            self.parent.total += delta
+            self.parent.total_size += new_keys
 
     def totalCount(self):
-        total = 0
-        for key in self.keySet():
-            total += self.entries[key]
-        return total
+        return self.total
 
     def normalize(self):
         total = self.totalCount()
         for key in self.keySet():
             self.entries[key] = self.entries[key] / total
+        self._update_total(sum(self.entries.itervalues()) - total, 0)
+
+    def normalized(self):
+        """Returns a normalized view of this counter; see NormalizedCounter."""
+        return NormalizedCounter(self)
+
+    def merge(self, other):
+        """Adds the counts from other, which can be any kind of counter, to
+        this one."""
+        entries = self.entries
+        new_keys = 0
+        for key, count in other.items():
+            if key in entries:
+                entries[key] += count
+            else:
+                entries[key] = count
+                new_keys += 1
+        self._update_total(other.totalCount(), new_keys)
+
+    def incrementCounts(self, keys, incs):
+        """Calls incrementCount(key, inc) for each pair of keys and incs."""
+        for key, inc in zip(keys, incs):
+            self.incrementCount(key, inc)
+
+    def save_snapshot(self, f):
+        """Writes the counter to f (a file object or a filename) in a compact
+        binary format.  The keys need to be strings."""
+        _save_counter_snapshot(self, f)
+
+    @classmethod
+    def read_snapshot(cls, f):
+        return _read_counter_snapshot(cls, f)
+
+    def sorted(self):
+        return sorted(((count, key) for key, count in self.entries.iteritems()),
+                reverse=True)
+
+    def most_common(self, k=None):
+        """Returns the k (count, key) pairs with the largest counts, in the
+        same order as sorted(), but without sorting the whole counter."""
+        if k is None:
+            return self.sorted()
+        return nlargest(k, ((count, key) for key, count in
+            self.entries.iteritems()))
+
+
+class ArrayCounter(object):
+    """A Counter with the same interface, but with the keys interned through an
+    Index and the counts kept in numpy arrays: a sorted array of the ids of
+    the counter's keys, and an array of their counts.
+
+    The memory savings come from sharing one Index between many counters, as
+    ArrayCounterMap does for its rows: each key's string is then stored once,
+    and each counter only holds 16 bytes per key.  (A counter with an Index
+    of its own is about as big as a Counter.)  New increments go into a small
+    dict, pending, which is merged into the arrays in one vectorized step
+    once it holds more than a quarter as many keys as the arrays do, or when
+    something needs all of the counts; flush does it explicitly.
+
+    Counts keep the type of what was added to them, so integer counts stay
+    integers, and getCount and items return Python numbers."""
+    def __init__(self, index=None):
+        if index is None:
+            index = Index()
+        self.index = index
+        self.ids = numpy.zeros(0, dtype=numpy.int64)
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.pending = dict()
+        self.max_pending = 64
+        # As in Counter.
+        self.total = 0
+        self.parent = None
+
+    def _find(self, index):
+        """The position of index in self.ids, or -1."""
+        position = int(self.ids.searchsorted(index))
+        if position < len(self.ids) and self.ids[position] == index:
+            return position
+        return -1
+
+    def flush(self):
+        """Merges the pending increments into the arrays."""
+        if not self.pending:
+            return
+        ids = numpy.fromiter(self.pending.iterkeys(), dtype=numpy.int64,
+                count=len(self.pending))
+        incs = numpy.array(self.pending.values())
+        self.pending = dict()
+        # Neither the arrays nor pending have repeated ids, so after a stable
+        # sort each id shows up at most twice, with the old count first.
+        ids = numpy.concatenate([self.ids, ids])
+        counts = numpy.concatenate([self.counts, incs])
+        order = ids.argsort(kind='mergesort')
+        ids = ids[order]
+        counts = counts[order]
+        repeats = numpy.flatnonzero(ids[1:] == ids[:-1])
+        counts[repeats] += counts[repeats + 1]
+        keep = numpy.ones(len(ids), dtype=bool)
+        keep[repeats + 1] = False
+        new_keys = len(ids) - len(self.ids) - len(repeats)
+        self.ids = ids[keep]
+        self.counts = counts[keep]
+        self.max_pending = max(64, len(self.ids) // 4)
+        self._update_total(0, new_keys)
+
+    def keySet(self):
+        self.flush()
+        strings = self.index.array
+        return [strings[i] for i in self.ids.tolist()]
+
+    def items(self):
+        return zip(self.keySet(), self.counts.tolist())
+
+    def size(self):
+        self.flush()
+        return len(self.ids)
+
+    def isEmpty(self):
+        return not self.pending and not len(self.ids)
+
+    def containsKey(self, key):
+        index = self.index.strings.get(key, None)
+        if index is None:
+            return False
+        return index in self.pending or self._find(index) >= 0
+
+    def getCount(self, key):
+        index = self.index.strings.get(key, None)
+        if index is None:
+            return 0
+        count = self.pending.get(index, 0)
+        position = self._find(index)
+        if position >= 0:
+            count = count + self.counts[position].item()
+        return count
+
+    def setCount(self, key, count):
+        self.incrementCount(key, count - self.getCount(key))
+
+    def incrementCount(self, key, inc):
+        # This is the hot loop of most counting jobs, hence the inlining.
+        index = self.index.strings.get(key, None)
+        if index is None:
+            index = self.index.getIndex(key)
+        pending = self.pending
+        parent = self.parent
+        if index in pending:
+            pending[index] += inc
+        else:
+            if not pending and parent is not None:
+                parent.dirty.add(self)
+            pending[index] = inc
+        self.total += inc
+        if parent is not None:
+            parent.total += inc
+        if len(pending) > self.max_pending:
+            self.flush()
+
+    def _update_total(self, delta, new_keys):
+        self.total += delta
+        if self.parent is not None:
+            self.parent.total += delta
+            self.parent.total_size += new_keys
+
+    def totalCount(self):
+        return self.total
+
+    def normalize(self):
+        self.flush()
+        total = self.totalCount()
+        self.counts = self.counts / total
+        self._update_total(self.counts.sum().item() - total, 0)
+
+    def normalized(self):
+        return NormalizedCounter(self)
+
+    def merge(self, other):
+        """Adds the counts from other to this counter.  This is vectorized
+        when other is also an ArrayCounter, and doesn't touch the strings at
+        all if it shares this counter's Index."""
+        if isinstance(other, ArrayCounter):
+            other.flush()
+            if other.index is self.index:
+                self._add_arrays(other.ids, other.counts)
+                return
+        items = other.items()
+        self.incrementCounts([key for key, _ in items],
+                [count for _, count in items])
+
+    def incrementCounts(self, keys, incs):
+        """Calls incrementCount(key, inc) for each pair of keys and incs, but
+        with a single vectorized update of the counts."""
+        ids = numpy.array(self.index.getIndices(keys), dtype=numpy.int64)
+        self._add_arrays(ids, numpy.asarray(incs))
+
+    def _add_arrays(self, ids, incs):
+        self.flush()
+        if not len(ids):
+            return
+        all_ids = numpy.concatenate([self.ids, ids])
+        unique, inverse = numpy.unique(all_ids, return_inverse=True)
+        counts = numpy.zeros(len(unique), dtype=numpy.result_type(self.counts,
+            incs))
+        numpy.add.at(counts, inverse, numpy.concatenate([self.counts, incs]))
+        new_keys = len(unique) - len(self.ids)
+        self.ids = unique
+        self.counts = counts
+        self.max_pending = max(64, len(self.ids) // 4)
+        self._update_total(incs.sum().item(), new_keys)
+
+    def save_snapshot(self, f):
+        _save_counter_snapshot(self, f)
+
+    @classmethod
+    def read_snapshot(cls, f):
+        return _read_counter_snapshot(cls, f)
+
+    def _order(self, positions):
+        """Sorts positions in the arrays like Counter.sorted sorts its items:
+        largest count first, and ties broken by the larger key."""
+        keys = numpy.empty(len(positions), dtype=object)
+        strings = self.index.array
+        keys[:] = [strings[i] for i in self.ids[positions].tolist()]
+        key_ranks = numpy.empty(len(positions), dtype=numpy.int64)
+        key_ranks[keys.argsort(kind='mergesort')] = numpy.arange(len(keys))
+        order = numpy.lexsort((key_ranks, self.counts[positions]))[::-1]
+        return zip(self.counts[positions][order].tolist(),
+                keys[order].tolist())
 
     def sorted(self):
-        heap = []
-        for item in self.keySet():
-            heappush(heap, (self.getCount(item), item))
-        heap.sort()
-        heap.reverse()
-        return heap
+        """Returns (count, key) pairs, in the same order as Counter.sorted,
+        sorted with numpy."""
+        self.flush()
+        return self._order(numpy.arange(len(self.ids)))
+
+    def most_common(self, k=None):
+        """Like sorted(), but only the top k, found with a partial selection
+        instead of a full sort."""
+        size = self.size()
+        if k is None or k >= size:
+            return self.sorted()
+        if k <= 0:
+            return []
+        # Every key with a count above the kth largest is in the top k; of
+        # the ones tied with it, _order picks the same ones sorted() would.
+        threshold = numpy.partition(self.counts, size - k)[size - k]
+        return self._order(numpy.flatnonzero(self.counts >= threshold))[:k]
+
+
+class SpaceSavingCounter(object):
+    """Approximate counts for the most frequent keys of an unbounded stream,
+    using memory for at most `capacity` keys (the Space-Saving algorithm of
+    Metwally et al.).
+
+    When a new key arrives and the counter is full, the key with the smallest
+    count is evicted and the new key inherits its count.  So counts are
+    overestimates, by at most getError(key), and any key whose true count is
+    more than totalCount() / capacity is guaranteed to be kept.  Increments
+    must be positive."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = dict()
+        self.errors = dict()
+        self.total = 0
+        # A min-heap of (count, key).  Entries go stale when a key's count
+        # changes; stale entries are skipped when we look for the minimum, and
+        # the heap is rebuilt when too many of them pile up.
+        self.heap = []
+
+    def keySet(self):
+        return self.entries.keys()
+
+    def size(self):
+        return len(self.entries)
+
+    def isEmpty(self):
+        return self.size() == 0
+
+    def containsKey(self, key):
+        return key in self.entries
+
+    def getCount(self, key):
+        return self.entries.get(key, 0)
+
+    def getError(self, key):
+        return self.errors.get(key, 0)
+
+    def totalCount(self):
+        return self.total
+
+    def incrementCount(self, key, inc=1):
+        self.total += inc
+        if key in self.entries:
+            count = self.entries[key] + inc
+        elif len(self.entries) < self.capacity:
+            count = inc
+            self.errors[key] = 0
+        else:
+            min_count, min_key = self._pop_min()
+            del self.entries[min_key]
+            del self.errors[min_key]
+            count = min_count + inc
+            self.errors[key] = min_count
+        self.entries[key] = count
+        heappush(self.heap, (count, key))
+        if len(self.heap) > 4 * self.capacity:
+            self._rebuild_heap()
+
+    def _pop_min(self):
+        while True:
+            count, key = heappop(self.heap)
+            if self.entries.get(key, None) == count:
+                return count, key
+
+    def _rebuild_heap(self):
+        self.heap = [(count, key) for key, count in self.entries.iteritems()]
+        heapify(self.heap)
+
+    def sorted(self):
+        return sorted(((count, key) for key, count in self.entries.iteritems()),
+                reverse=True)
+
+    def most_common(self, k=None):
+        if k is None:
+            return self.sorted()
+        return nlargest(k, ((count, key) for key, count in
+            self.entries.iteritems()))
+
+
+class NormalizedCounter(object):
+    """A read-only view of a counter, with every count divided by the
+    counter's total at the time it is read.  Making the view is O(1), and the
+    underlying counts are never modified, so they can keep changing while the
+    view is in use (between EM iterations, say).  An empty counter (or one
+    whose total is 0) reads as all zeros."""
+    def __init__(self, counter):
+        self.counter = counter
+
+    def keySet(self):
+        return self.counter.keySet()
+
+    def size(self):
+        return self.counter.size()
+
+    def isEmpty(self):
+        return self.counter.isEmpty()
+
+    def containsKey(self, key):
+        return self.counter.containsKey(key)
+
+    def getCount(self, key):
+        return _divide(self.counter.getCount(key), self.counter.totalCount())
+
+    def totalCount(self):
+        total = self.counter.totalCount()
+        return _divide(total, total)
+
+    def sorted(self):
+        total = self.counter.totalCount()
+        return [(_divide(count, total), key) for count, key in
+                self.counter.sorted()]
+
+    def most_common(self, k=None):
+        total = self.counter.totalCount()
+        return [(_divide(count, total), key) for count, key in
+                self.counter.most_common(k)]
+
+
+def _divide(count, total):
+    if total == 0:
+        return 0
+    return count / total
 
 
 class CounterMap:
+    counter_class = Counter
+
     def __init__(self):
         self.map = dict()
+        # Running totals, kept up to date by the rows; see Counter.
+        self.total = 0
+        self.total_size = 0
 
     def keySet(self):
         return self.map.keys()
 
     def setCount(self, key, value, count):
         if key not in self.map:
-            self.map[key] = Counter()
+            self.map[key] = self._new_counter()
         self.map[key].setCount(value, count)
 
     def incrementCount(self, key, value, count):
         if key not in self.map:
-            self.map[key] = Counter()
+            self.map[key] = self._new_counter()
         self.map[key].incrementCount(value, count)
 
+    def _new_counter(self):
+        counter = self.counter_class()
+        counter.parent = self
+        return counter
+
     def getCount(self, key, value):
         if key not in self.map:
             return 0
@@ -128,28 +859,114 @@ class CounterMap:
 
     def getCounter(self, key):
         if key not in self.map:
-            self.map[key] = Counter()
+            self.map[key] = self._new_counter()
         return self.map[key]
 
     def __getitem__(self, key):
         return self.getCounter(key)
 
     def totalCount(self):
-        total = 0
-        for key in self.keySet():
-            total += self.map[key].totalCount()
-        return total
+        return self.total
 
     def totalSize(self):
-        total = 0
-        for key in self.keySet():
-            total += self.map[key].size()
-        return total
+        return self.total_size
 
     def normalize(self):
         for key in self.keySet():
             self.map[key].normalize()
 
+    def normalized(self):
+        """Returns a view with each row normalized; see NormalizedCounterMap."""
+        return NormalizedCounterMap(self)
+
+    def merge(self, other):
+        """Adds the counts from another CounterMap to this one."""
+        for key, counter in other.map.iteritems():
+            self.getCounter(key).merge(counter)
+
+    def to_csr(self, key_index, value_index):
+        """Returns the counts as a scipy.sparse.csr_matrix, with the count for
+        (key, value) at [key_index.getIndex(key), value_index.getIndex(value)].
+        Keys and values that aren't in the indices yet get added to them.
+        Indices start at 1, so row 0 and column 0 are always empty."""
+        from scipy.sparse import coo_matrix
+        rows = []
+        columns = []
+        data = []
+        for key, counter in self.map.iteritems():
+            items = counter.items()
+            rows.extend([key_index.getIndex(key)] * len(items))
+            columns.extend(value_index.getIndices([value for value, _ in items]))
+            data.extend([count for _, count in items])
+        shape = (key_index.current_index, value_index.current_index)
+        return coo_matrix((data, (rows, columns)), shape=shape).tocsr()
+
+    def save_snapshot(self, f):
+        """Writes the CounterMap to f (a file object or a filename) in a
+        compact binary format: the keys, the distinct values, and then the
+        counts as row offsets, value numbers and counts, like a CSR matrix.
+        Keys and values need to be strings."""
+        f, close = _open(f, 'wb')
+        keys = self.map.keys()
+        value_index = Index()
+        offsets = [0]
+        columns = []
+        data = []
+        for key in keys:
+            items = self.map[key].items()
+            columns.extend(value_index.getIndices([value for value, _ in items]))
+            data.extend([count for _, count in items])
+            offsets.append(len(columns))
+        f.write(COUNTER_MAP_SNAPSHOT_MAGIC)
+        _save_strings(f, keys)
+        _save_strings(f, value_index.getAllStrings())
+        numpy.save(f, numpy.array(offsets, dtype=numpy.int64))
+        numpy.save(f, numpy.array(columns, dtype=numpy.int64) - 1)
+        numpy.save(f, numpy.array(data))
+        if close:
+            f.close()
+
+    @classmethod
+    def read_snapshot(cls, f):
+        """Reads a CounterMap written by save_snapshot."""
+        f, close = _open(f, 'rb')
+        _check_magic(f, COUNTER_MAP_SNAPSHOT_MAGIC)
+        keys = _read_strings(f)
+        values = _read_strings(f)
+        offsets = numpy.load(f).tolist()
+        columns = numpy.load(f).tolist()
+        data = numpy.load(f).tolist()
+        if close:
+            f.close()
+        counter_map = cls()
+        for i, key in enumerate(keys):
+            start, end = offsets[i], offsets[i + 1]
+            counter_map.getCounter(key).incrementCounts(
+                    [values[column] for column in columns[start:end]],
+                    data[start:end])
+        return counter_map
+
+    @classmethod
+    def from_csr(cls, matrix, key_index, value_index):
+        """The inverse of to_csr: builds a CounterMap from a sparse matrix,
+        using the indices to turn rows and columns back into keys and
+        values.  Duplicate entries are added together, and explicit zeros
+        are left out, as they would be in to_csr's output."""
+        # tocsr leaves a CSR matrix as it is, so we clean up a copy.
+        matrix = matrix.tocsr(copy=True)
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+        counter_map = cls()
+        indptr = matrix.indptr.tolist()
+        values = [value_index.getString(column) for column in
+                matrix.indices.tolist()]
+        counts = matrix.data.tolist()
+        for row in numpy.flatnonzero(numpy.diff(matrix.indptr)).tolist():
+            counter = counter_map.getCounter(key_index.getString(row))
+            for i in xrange(indptr[row], indptr[row + 1]):
+                counter.setCount(values[i], counts[i])
+        return counter_map
+
     def size(self):
         return len(self.map)
 
@@ -157,6 +974,295 @@ class CounterMap:
         return self.size() == 0
 
 
+class NormalizedCounterMap(object):
+    """A read-only view of a CounterMap with each row normalized, as
+    CounterMap.normalize would do, but computed at read time like
+    NormalizedCounter."""
+    def __init__(self, counter_map):
+        self.counter_map = counter_map
+
+    def keySet(self):
+        return self.counter_map.keySet()
+
+    def getCount(self, key, value):
+        if key not in self.counter_map.map:
+            return 0
+        counter = self.counter_map.map[key]
+        return _divide(counter.getCount(value), counter.totalCount())
+
+    def getCounter(self, key):
+        if key not in self.counter_map.map:
+            return NormalizedCounter(self.counter_map.counter_class())
+        return NormalizedCounter(self.counter_map.map[key])
+
+    def __getitem__(self, key):
+        return self.getCounter(key)
+
+    def totalSize(self):
+        return self.counter_map.totalSize()
+
+    def size(self):
+        return self.counter_map.size()
+
+    def isEmpty(self):
+        return self.size() == 0
+
+
+class ArrayCounterMap(CounterMap):
+    """A CounterMap whose rows are ArrayCounters, all sharing one Index of the
+    values (index, if you pass one), so each value's string is stored once no
+    matter how many rows it's in."""
+    counter_class = ArrayCounter
+
+    def __init__(self, index=None):
+        CounterMap.__init__(self)
+        if index is None:
+            index = Index()
+        self.index = index
+        # Rows with pending increments, which might add keys that
+        # total_size doesn't know about yet.
+        self.dirty = set()
+
+    def _new_counter(self):
+        counter = self.counter_class(self.index)
+        counter.parent = self
+        return counter
+
+    def flush(self):
+        """Flushes the pending increments of every row; see
+        ArrayCounter.flush."""
+        for counter in self.dirty:
+            counter.flush()
+        self.dirty = set()
+
+    def totalSize(self):
+        self.flush()
+        return self.total_size
+
+
+class CounterMapLog(object):
+    """An append-only log of CounterMap increments, for checkpointing long
+    counting jobs.
+
+    Count into a fresh CounterMap for a while, append it to the log along
+    with how far into the input you got, and start a new one.  Each append
+    is flushed to disk, and is cheap because it only writes the new counts.
+    After a crash, recover() gives back the counts and the position to
+    resume reading from.  When the log gets long, compact it into a snapshot
+    (snapshot_filename, by default the log's filename plus '.snapshot').
+
+    Compacting can't rewrite the snapshot and empty the log in one atomic
+    step, so the log starts with a generation number, and the snapshot says
+    which generation of the log it covers and how far into it.  The snapshot
+    is renamed into place first, and then the log is replaced with an empty
+    one of the next generation; a crash in between leaves a log whose
+    records the snapshot already covers, and replay skips them."""
+    def __init__(self, filename, snapshot_filename=None):
+        self.filename = filename
+        if snapshot_filename is None:
+            snapshot_filename = filename + '.snapshot'
+        self.snapshot_filename = snapshot_filename
+        if not os.path.exists(self.filename):
+            self._start_log(self._read_snapshot_header()[0] + 1)
+        self._truncate_partial_record()
+
+    def append(self, delta, position=0):
+        """Appends the counts in delta, a CounterMap, to the log."""
+        snapshot = StringIO()
+        delta.save_snapshot(snapshot)
+        snapshot = snapshot.getvalue()
+        f = open(self.filename, 'ab')
+        f.write(struct.pack(COUNTER_MAP_LOG_RECORD, len(snapshot), position))
+        f.write(snapshot)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def recover(self, counter_map_class=None):
+        """Returns the counts in the snapshot plus every record of the log
+        that it doesn't cover, as a counter_map_class (CounterMap by
+        default), and the position to resume from (None if nothing was ever
+        logged)."""
+        if counter_map_class is None:
+            counter_map_class = CounterMap
+        _, _, position = self._read_snapshot_header()
+        if os.path.exists(self.snapshot_filename):
+            f = open(self.snapshot_filename, 'rb')
+            f.seek(struct.calcsize(COUNTER_MAP_LOG_SNAPSHOT_HEADER))
+            counter_map = counter_map_class.read_snapshot(f)
+            f.close()
+        else:
+            counter_map = counter_map_class()
+        logged = self.replay(counter_map)
+        if logged is not None:
+            position = logged
+        return counter_map, position
+
+    def replay(self, counter_map):
+        """Merges every record in the log that the snapshot doesn't already
+        cover into counter_map, and returns the position of the last one
+        (None if there are none)."""
+        generation, covered, _ = self._read_snapshot_header()
+        position = None
+        f = open(self.filename, 'rb')
+        log_generation = self._read_log_header(f)
+        if log_generation < generation:
+            raise ValueError('%s is older than its snapshot' % self.filename)
+        if log_generation > generation:
+            covered = 0
+        record_size = struct.calcsize(COUNTER_MAP_LOG_RECORD)
+        while True:
+            start = f.tell()
+            header = f.read(record_size)
+            if len(header) < record_size:
+                break
+            length, record_position = struct.unpack(COUNTER_MAP_LOG_RECORD,
+                    header)
+            if start < covered:
+                f.seek(length, os.SEEK_CUR)
+                continue
+            delta = counter_map.read_snapshot(StringIO(f.read(length)))
+            counter_map.merge(delta)
+            position = record_position
+        f.close()
+        return position
+
+    def compact(self, counter_map, position=None):
+        """Saves counter_map, which should be what recover() would return
+        (plus nothing that isn't in the log), as the snapshot, and then
+        empties the log.  position defaults to that of the log's last
+        record."""
+        f = open(self.filename, 'rb')
+        generation = self._read_log_header(f)
+        covered, last_position = self._scan(f)
+        f.close()
+        if position is None:
+            position = last_position
+        if position is None:
+            position = self._read_snapshot_header()[2]
+        temp_filename = self.snapshot_filename + '.tmp'
+        f = open(temp_filename, 'wb')
+        f.write(struct.pack(COUNTER_MAP_LOG_SNAPSHOT_HEADER,
+            COUNTER_MAP_LOG_SNAPSHOT_MAGIC, generation, covered,
+            position is not None, position or 0))
+        counter_map.save_snapshot(f)
+        _sync_and_close(f)
+        os.rename(temp_filename, self.snapshot_filename)
+        _sync_directory(self.snapshot_filename)
+        self._start_log(generation + 1)
+
+    def _start_log(self, generation):
+        temp_filename = self.filename + '.tmp'
+        f = open(temp_filename, 'wb')
+        f.write(struct.pack(COUNTER_MAP_LOG_HEADER, COUNTER_MAP_LOG_MAGIC,
+            generation))
+        _sync_and_close(f)
+        os.rename(temp_filename, self.filename)
+        _sync_directory(self.filename)
+
+    def _read_log_header(self, f):
+        header = f.read(struct.calcsize(COUNTER_MAP_LOG_HEADER))
+        magic, generation = struct.unpack(COUNTER_MAP_LOG_HEADER, header)
+        if magic != COUNTER_MAP_LOG_MAGIC:
+            raise ValueError('%s is not a CounterMapLog' % self.filename)
+        return generation
+
+    def _read_snapshot_header(self):
+        """Returns the generation of the log that the snapshot covers, how
+        many bytes of it, and the position it was taken at; or (-1, 0, None)
+        if there is no snapshot."""
+        if not os.path.exists(self.snapshot_filename):
+            return -1, 0, None
+        f = open(self.snapshot_filename, 'rb')
+        header = f.read(struct.calcsize(COUNTER_MAP_LOG_SNAPSHOT_HEADER))
+        f.close()
+        magic, generation, covered, has_position, position = struct.unpack(
+                COUNTER_MAP_LOG_SNAPSHOT_HEADER, header)
+        if magic != COUNTER_MAP_LOG_SNAPSHOT_MAGIC:
+            raise ValueError('%s is not a CounterMapLog snapshot' %
+                    self.snapshot_filename)
+        if not has_position:
+            position = None
+        return generation, covered, position
+
+    def _scan(self, f):
+        """Reads the record headers from f, which is just past the log
+        header, and returns where the last complete record ends and its
+        position."""
+        file_size = os.fstat(f.fileno()).st_size
+        record_size = struct.calcsize(COUNTER_MAP_LOG_RECORD)
+        end = f.tell()
+        position = None
+        while end + record_size <= file_size:
+            f.seek(end)
+            length, record_position = struct.unpack(COUNTER_MAP_LOG_RECORD,
+                    f.read(record_size))
+            if end + record_size + length > file_size:
+                break
+            end += record_size + length
+            position = record_position
+        return end, position
+
+    def _truncate_partial_record(self):
+        # If we crashed in the middle of an append, the log ends with part of
+        # a record, which has to go before anything else is appended.
+        f = open(self.filename, 'r+b')
+        self._read_log_header(f)
+        end, _ = self._scan(f)
+        if end < os.fstat(f.fileno()).st_size:
+            f.truncate(end)
+        f.close()
+
+
+def _sync_and_close(f):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+
+def _sync_directory(filename):
+    """fsyncs the directory holding filename, so that a rename into it is on
+    disk too."""
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def parallel_count(shards, fn, processes=None):
+    """Calls fn on each shard in a pool of worker processes, and returns the
+    merge of the counters it returns (None, if there are no shards).
+
+    fn should return a Counter or CounterMap (or one of their array-backed
+    versions), and it and the shards have to be picklable, so fn needs to be
+    a module-level function.  The per-shard counters are merged pairwise in
+    the pool, as a tree, so that the merging is spread across the workers
+    too instead of all being done at the end in this process."""
+    pool = Pool(processes)
+    try:
+        counters = list(pool.imap_unordered(fn, shards))
+        while len(counters) > 1:
+            pairs = zip(counters[0::2], counters[1::2])
+            merged = pool.map(_merge_pair, pairs)
+            if len(counters) % 2 == 1:
+                merged.append(counters[-1])
+            counters = merged
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    if not counters:
+        return None
+    return counters[0]
+
+
+def _merge_pair(pair):
+    first, second = pair
+    first.merge(second)
+    return first
 
 
 # vim: et sw=4 sts=4
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from node import *
+from chains import *
 from plot import *
 
 # vim: et sw=4 sts=4
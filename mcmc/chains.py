@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+from __future__ import division
+from multiprocessing import Process, Queue
+from Queue import Empty
+import numpy
+
+from node import compile_model
+
+# How often (in seconds) to check that a chain's process is still alive while
+# waiting for its samples.
+POLL_INTERVAL = 1
+# Convergence is checked on chains split in half, and each half needs two
+# samples for a variance.
+MIN_SAMPLES = 4
+
+def run_chains(build_model, num_chains=4, seed=None, max_samples=10000,
+        burn=500, thin=1, chunk_size=500, rhat_threshold=1.01, min_ess=400,
+        adapt=True, parallel=True):
+    """Runs num_chains independent chains of a model until they converge.
+
+    build_model is a function that returns a list of nodes, which is passed
+    to compile_model in each chain; with parallel, every chain is run in its
+    own process, so build_model has to be picklable (defined at the top level
+    of a module).  Each chain gets its own random seed, drawn from seed.
+
+    During the burn sweeps, each chain tunes its proposals (unless adapt is
+    False; see MetropolisNode.adapt), and then freezes them.  After that the
+    chains take samples (one every thin sweeps) chunk_size at a time.  After
+    each chunk, we compute the split R-hat and effective sample size of every
+    node, and stop once every R-hat is below rhat_threshold and every
+    effective sample size is above min_ess, or when the chains have
+    max_samples samples each (at least MIN_SAMPLES).  Returns a Chains
+    object.  If a chain's process dies, we raise a RuntimeError instead of
+    waiting for it forever, and the other chains' processes are terminated.
+    """
+    if max_samples < MIN_SAMPLES:
+        raise ValueError('max_samples has to be at least %d' % MIN_SAMPLES)
+    if chunk_size < 1:
+        raise ValueError('chunk_size has to be positive')
+    seeds = numpy.random.RandomState(seed).randint(2**31, size=num_chains)
+    if parallel:
+        runners = [_ProcessChain(build_model, s, burn, thin, adapt) for s in
+                seeds]
+    else:
+        runners = [_LocalChain(build_model, s, burn, thin, adapt) for s in
+                seeds]
+    finished = False
+    try:
+        names = runners[0].names()
+        for runner in runners[1:]:
+            runner.names()
+        samples = numpy.empty((num_chains, max_samples, len(names)))
+        num_samples = 0
+        while num_samples < max_samples:
+            size = min(chunk_size, max_samples - num_samples)
+            for runner in runners:
+                runner.start(size)
+            for i, runner in enumerate(runners):
+                samples[i, num_samples:num_samples+size] = runner.result()
+            num_samples += size
+            if num_samples < MIN_SAMPLES:
+                continue
+            chains = Chains(samples[:,:num_samples], names)
+            if chains.converged(rhat_threshold, min_ess):
+                break
+        finished = True
+    finally:
+        # After an error, other chains may be in the middle of a chunk, or
+        # have results that will never be read (and that keep them from
+        # exiting), so they are terminated instead.
+        for runner in runners:
+            runner.stop(terminate=not finished)
+    return chains
+
+
+class Chains(object):
+    """Samples from several chains, as an array with shape (chains, samples,
+    nodes), along with the names of the nodes and their split R-hat and
+    effective sample sizes."""
+    def __init__(self, samples, names):
+        self.samples = samples
+        self.names = names
+        self.rhat = split_rhat(samples)
+        self.ess = effective_sample_size(samples)
+
+    def converged(self, rhat_threshold=1.01, min_ess=400):
+        return ((self.rhat < rhat_threshold).all() and
+                (self.ess > min_ess).all())
+
+    def column(self, name):
+        """All of the samples for the named node, from every chain."""
+        return self.samples[:,:,self.names.index(name)].ravel()
+
+
+def split_rhat(samples):
+    """The split R-hat of each column of samples, which has shape (chains,
+    samples, nodes): each chain is split in half, and the variance between
+    the halves is compared to the variance within them.  Values near 1 mean
+    the chains have mixed."""
+    samples = _split_chains(samples)
+    n = samples.shape[1]
+    within = samples.var(axis=1, ddof=1).mean(axis=0)
+    between = samples.mean(axis=1).var(axis=0, ddof=1)
+    with numpy.errstate(all='ignore'):
+        rhat = (((n - 1) / n * within + between) / within)**.5
+    # Nodes that never moved in any chain (like observed ones) are fine.
+    rhat[(within == 0) & (between == 0)] = 1
+    return rhat
+
+
+def effective_sample_size(samples):
+    """The effective sample size of each column of samples, which has shape
+    (chains, samples, nodes), from the autocorrelations of the split chains
+    (computed with FFTs), summed until they stop being positive."""
+    samples = _split_chains(samples)
+    m, n = samples.shape[:2]
+    centered = samples - samples.mean(axis=1)[:,numpy.newaxis]
+    size = 1
+    while size < 2 * n:
+        size *= 2
+    transform = numpy.fft.rfft(centered, size, axis=1)
+    autocovariance = numpy.fft.irfft(transform * transform.conj(), size,
+            axis=1)[:,:n] / n
+    within = autocovariance[:,0].mean(axis=0) * n / (n - 1)
+    between = samples.mean(axis=1).var(axis=0, ddof=1)
+    variance = (n - 1) / n * within + between
+    with numpy.errstate(all='ignore'):
+        rho = 1 - (within - autocovariance.mean(axis=0)) / variance
+    rho[0] = 1
+    # Geyer's initial positive sequence: add up pairs of autocorrelations
+    # until the first pair whose sum isn't positive.
+    pairs = rho[:n//2*2].reshape((n//2, 2) + rho.shape[1:]).sum(axis=1)
+    positive = numpy.cumprod(pairs > 0, axis=0)
+    tau = -1 + 2 * (pairs * positive).sum(axis=0)
+    with numpy.errstate(all='ignore'):
+        ess = m * n / numpy.maximum(tau, 1 / numpy.log10(m * n))
+    ess[variance == 0] = m * n
+    return ess
+
+
+def _split_chains(samples):
+    half = samples.shape[1] // 2
+    return numpy.concatenate([samples[:,:half], samples[:,half:2*half]])
+
+
+class _LocalChain(object):
+    """Runs a chain in this process, with the same interface as
+    _ProcessChain."""
+    def __init__(self, build_model, seed, burn, thin, adapt):
+        self.model = compile_model(*build_model(), seed=seed)
+        self.model.sample(0, burn, adapt=adapt)
+        self.thin = thin
+
+    def names(self):
+        return self.model.names
+
+    def start(self, size):
+        self.size = size
+
+    def result(self):
+        return self.model.sample(self.size, thin=self.thin)
+
+    def stop(self, terminate=False):
+        pass
+
+
+class _ProcessChain(object):
+    """Runs a chain in a separate process, which takes the number of samples
+    to take next from one queue, and puts the samples on another; None
+    stops it."""
+    def __init__(self, build_model, seed, burn, thin, adapt):
+        self.commands = Queue()
+        self.results = Queue()
+        self.process = Process(target=_chain_worker, args=(build_model, seed,
+            burn, thin, adapt, self.commands, self.results))
+        self.process.daemon = True
+        self.process.start()
+
+    def names(self):
+        return self.result()
+
+    def start(self, size):
+        self.commands.put(size)
+
+    def result(self):
+        while True:
+            # Anything the process put before it died will be there by the
+            # time get times out, so we check if it's alive first.
+            alive = self.process.is_alive()
+            try:
+                result = self.results.get(timeout=POLL_INTERVAL)
+                break
+            except Empty:
+                if not alive:
+                    raise RuntimeError('Chain process died with exit code %s' %
+                            self.process.exitcode)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stop(self, terminate=False):
+        """Stops the process, once it has finished its chunk, or right away
+        with terminate."""
+        if terminate:
+            self.process.terminate()
+        elif self.process.is_alive():
+            self.commands.put(None)
+        self.process.join()
+
+
+def _chain_worker(build_model, seed, burn, thin, adapt, commands, results):
+    try:
+        model = compile_model(*build_model(), seed=seed)
+        results.put(model.names)
+        model.sample(0, burn, adapt=adapt)
+        samples = None
+        while True:
+            size = commands.get()
+            if size is None:
+                return
+            if samples is None or len(samples) != size:
+                samples = numpy.empty((size, len(model.columns)))
+            results.put(model.sample(size, thin=thin, out=samples))
+    except Exception, e:
+        results.put(e)
+
+
+# vim: et sw=4 sts=4
@@ -2,22 +2,101 @@
 
 from __future__ import division
 from scipy import special, stats
+import numpy
 import random, math
 from math import pi
 
 DEFAULT_SAMPLE_STDDEV = .2
+# The acceptance rate that adaptive proposals aim for, which is optimal for
+# one-dimensional random walk Metropolis updates.
+TARGET_ACCEPTANCE_RATE = .44
+# Adaptation step t changes log(sample_stddev) by t^-ADAPTATION_DECAY times
+# the difference between the acceptance and the target, so the steps shrink
+# but still add up to enough to reach any scale.
+ADAPTATION_DECAY = .6
+
+# Vectorized versions of the nodes' logconditional and outside_support
+# methods, used by CompiledModel.  Each log density takes arrays of values and
+# of each parent's values, in the order of the node's parent_names.  Values
+# outside the support give -inf or nan, so callers should ignore numpy's
+# floating point warnings.
+
+def normal_logpdf(x, mean, var):
+    # The .5/var (rather than 1/var) matches NormalNode.logconditional, so
+    # that compiled models sample the same distribution.
+    logp = -1/2 * (numpy.log(2*pi*var) + .5/var * (x - mean)**2)
+    return numpy.where(var == 0, -numpy.inf, logp)
+
+
+def gamma_logpdf(x, shape, inv_scale):
+    return (shape * numpy.log(inv_scale) - special.gammaln(shape) +
+                (shape - 1) * numpy.log(x) - inv_scale * x)
+
+
+def inv_gamma_logpdf(x, shape, scale):
+    return (shape * numpy.log(scale) - special.gammaln(shape) -
+                (shape + 1) * numpy.log(x) - scale / x)
+
+
+def poisson_logpdf(x, lamda):
+    return x * numpy.log(lamda) - lamda - special.gammaln(x + 1)
+
+
+def beta_logpdf(x, alpha, beta):
+    return (special.gammaln(alpha+beta) - special.gammaln(alpha) -
+                special.gammaln(beta) + (alpha-1) * numpy.log(x) +
+                (beta-1) * numpy.log(1-x))
+
+
+def bernoulli_logpdf(x, p):
+    return numpy.where(x == 1, numpy.log(p), numpy.log(1-p))
+
+
+def binomial_logpdf(x, n, p):
+    return (special.gammaln(n+1) - special.gammaln(x+1) -
+                special.gammaln(n-x+1) + x * numpy.log(p) +
+                (n-x) * numpy.log(1-p))
+
+
+def never_outside(x):
+    return numpy.zeros(len(x), dtype=bool)
+
+
+def outside_positive(x):
+    return x <= 0
+
+
+def outside_non_negative(x):
+    return x < 0
+
+
+def outside_unit_interval(x):
+    return (1 < x) | (x < 0)
+
 
 def sample_generator(*nodes, **kwds):
+    """Yields a sample (a dict from node names to values) after each sweep
+    through nodes.  With adapt=n, the nodes tune their proposals (see
+    MetropolisNode.adapt) for the first n sweeps, and keep them fixed after.
+    """
     print 'Starting the sampler'
     if 'output_rate' in kwds:
         output_rate = kwds['output_rate']
     else:
         output_rate = 500
+    adapt = kwds.get('adapt', 0)
+    for node in nodes:
+        if adapt and isinstance(node, MetropolisNode):
+            node.adapting = True
     i = 0
     while True:
         i += 1
         if i%output_rate == 0:
             print 'Yielding the %dth sample' % i
+        if i == adapt + 1:
+            for node in nodes:
+                if isinstance(node, MetropolisNode):
+                    node.stop_adapting()
         sample = dict()
         for node in nodes:
             sample[node.name] = node.sample()
@@ -49,12 +128,25 @@ class Constant(object):
 
 
 class MetropolisNode(object):
+    # What compile_model needs to know about each kind of node: the
+    # attributes that hold its parents, and vectorized versions of
+    # logconditional and outside_support.  Discrete nodes round their
+    # candidates.
+    parent_names = ()
+    array_logpdf = None
+    array_outside_support = staticmethod(never_outside)
+    discrete = False
+
     def __init__(self, value, name, observed):
         self.value = value
         self.name = name
         self.observed = observed
         self.children = []
         self.sample_stddev = DEFAULT_SAMPLE_STDDEV
+        self.accepted = 0
+        self.proposed = 0
+        self.adapting = False
+        self.adaptations = 0
 
     def generate_candidate(self, prev_value, stddev):
         return random.normalvariate(mu=prev_value, sigma=stddev)
@@ -62,8 +154,10 @@ class MetropolisNode(object):
     def sample(self):
         if self.observed:
             return self.value
+        self.proposed += 1
         cand = self.generate_candidate(self.value, self.sample_stddev)
         if self.outside_support(cand):
+            self.adapt(False)
             return self.value
         old_log_lh = self.loglikelihood()
         old_value = self.value
@@ -73,9 +167,38 @@ class MetropolisNode(object):
         u = math.log(random.uniform(0, 1))
         if u > (new_log_lh - old_log_lh):
             self.value = old_value
+            self.adapt(False)
+        else:
+            self.accepted += 1
+            self.adapt(True)
 
         return self.value
 
+    def adapt(self, accepted):
+        """If the node is adapting, nudges sample_stddev after a proposal:
+        up if it was accepted, down if not, with a Robbins-Monro step size
+        that shrinks over time, so that the acceptance rate converges to
+        TARGET_ACCEPTANCE_RATE."""
+        if not self.adapting:
+            return
+        self.adaptations += 1
+        step = self.adaptations**-ADAPTATION_DECAY
+        self.sample_stddev *= math.exp(step * (accepted -
+            TARGET_ACCEPTANCE_RATE))
+
+    def stop_adapting(self):
+        """Freezes sample_stddev (adapting forever wouldn't leave the
+        stationary distribution alone) and resets the acceptance counts, so
+        that they describe the frozen proposal."""
+        self.adapting = False
+        self.accepted = 0
+        self.proposed = 0
+
+    def acceptance_rate(self):
+        if not self.proposed:
+            return float('nan')
+        return self.accepted / self.proposed
+
     def loglikelihood(self):
         log_lh = self.logconditional()
         for child in self.children:
@@ -96,6 +219,9 @@ class MetropolisNode(object):
 
 
 class NormalNode(MetropolisNode):
+    parent_names = ('mean', 'var')
+    array_logpdf = staticmethod(normal_logpdf)
+
     def __init__(self, initial_value, name='', mean=None, var=None,
             observed=False):
         super(NormalNode, self).__init__(initial_value, name, observed)
@@ -132,6 +258,10 @@ class NormalNode(MetropolisNode):
 
 
 class NormalNodeNonNegative(MetropolisNode):
+    parent_names = ('mean', 'var')
+    array_logpdf = staticmethod(normal_logpdf)
+    array_outside_support = staticmethod(outside_positive)
+
     def __init__(self, initial_value, name='', mean=None, var=None,
             observed=False):
         super(NormalNodeNonNegative, self).__init__(initial_value, name,
@@ -171,6 +301,10 @@ class NormalNodeNonNegative(MetropolisNode):
     
 
 class GammaNode(MetropolisNode):
+    parent_names = ('shape', 'inv_scale')
+    array_logpdf = staticmethod(gamma_logpdf)
+    array_outside_support = staticmethod(outside_positive)
+
     def __init__(self, initial_value, name='', shape=None, inv_scale=None,
             observed=False):
         super(GammaNode, self).__init__(initial_value, name, observed)
@@ -203,6 +337,10 @@ class GammaNode(MetropolisNode):
 
 
 class InvGammaNode(MetropolisNode):
+    parent_names = ('shape', 'scale')
+    array_logpdf = staticmethod(inv_gamma_logpdf)
+    array_outside_support = staticmethod(outside_positive)
+
     def __init__(self, initial_value, name='', shape=None, scale=None,
             observed=False):
         super(InvGammaNode, self).__init__(initial_value, name, observed)
@@ -235,6 +373,11 @@ class InvGammaNode(MetropolisNode):
 
 
 class PoissonNode(MetropolisNode):
+    parent_names = ('lamda',)
+    array_logpdf = staticmethod(poisson_logpdf)
+    array_outside_support = staticmethod(outside_non_negative)
+    discrete = True
+
     def __init__(self, initial_value, name='', lamda=None, observed=False):
         super(PoissonNode, self).__init__(initial_value, name, observed)
         self.lamda = lamda
@@ -262,6 +405,10 @@ class PoissonNode(MetropolisNode):
 
 
 class BetaNode(MetropolisNode):
+    parent_names = ('alpha', 'beta')
+    array_logpdf = staticmethod(beta_logpdf)
+    array_outside_support = staticmethod(outside_unit_interval)
+
     def __init__(self, initial_value, name='', alpha=None, beta=None,
             observed=False):
         super(BetaNode, self).__init__(initial_value, name, observed)
@@ -293,6 +440,10 @@ class BetaNode(MetropolisNode):
 
 
 class BernoulliNode(MetropolisNode):
+    parent_names = ('p',)
+    array_logpdf = staticmethod(bernoulli_logpdf)
+    discrete = True
+
     def __init__(self, initial_value, name='', p=None, observed=False):
         super(BernoulliNode, self).__init__(initial_value, name, observed)
         self.p = p
@@ -331,6 +482,10 @@ class BernoulliNode(MetropolisNode):
 
 
 class BinomialNode(MetropolisNode):
+    parent_names = ('n', 'p')
+    array_logpdf = staticmethod(binomial_logpdf)
+    discrete = True
+
     def __init__(self, initial_value, name='', n=None, p=None, observed=False):
         super(BinomialNode, self).__init__(initial_value, name, observed)
         self.n = n
@@ -365,6 +520,73 @@ class BinomialNode(MetropolisNode):
         return self.value
 
 
+class Plate(MetropolisNode):
+    """Plates hold an array of i.i.d. observations that share their parents,
+    standing in for one observed node per observation.  Their logconditional
+    is the summed log density of the whole array, computed with one
+    vectorized call, so a parent with a million observations underneath it
+    doesn't have to loop over a million children.  Plates are always
+    observed."""
+    def __init__(self, values, name):
+        super(Plate, self).__init__(numpy.asarray(values), name, True)
+
+    def logconditional(self):
+        parents = [getattr(self, name).value for name in self.parent_names]
+        with numpy.errstate(all='ignore'):
+            return self.array_logpdf(self.value, *parents).sum()
+
+    def __len__(self):
+        return len(self.value)
+
+
+class NormalPlate(Plate):
+    parent_names = ('mean', 'var')
+    array_logpdf = staticmethod(normal_logpdf)
+
+    def __init__(self, values, name='', mean=None, var=None):
+        super(NormalPlate, self).__init__(values, name)
+        self.mean = mean
+        mean.children.append(self)
+        self.var = var
+        var.children.append(self)
+
+    def sample_given_parents(self):
+        self.value = numpy.random.normal(self.mean.value,
+                math.sqrt(self.var.value), size=len(self))
+        return self.value
+
+
+class PoissonPlate(Plate):
+    parent_names = ('lamda',)
+    array_logpdf = staticmethod(poisson_logpdf)
+    discrete = True
+
+    def __init__(self, values, name='', lamda=None):
+        super(PoissonPlate, self).__init__(values, name)
+        self.lamda = lamda
+        lamda.children.append(self)
+
+    def sample_given_parents(self):
+        self.value = numpy.random.poisson(self.lamda.value, size=len(self))
+        return self.value
+
+
+class BernoulliPlate(Plate):
+    parent_names = ('p',)
+    array_logpdf = staticmethod(bernoulli_logpdf)
+    discrete = True
+
+    def __init__(self, values, name='', p=None):
+        super(BernoulliPlate, self).__init__(values, name)
+        self.p = p
+        p.children.append(self)
+
+    def sample_given_parents(self):
+        self.value = (numpy.random.random_sample(len(self)) <
+                self.p.value).astype(int)
+        return self.value
+
+
 class FunctionNode(MetropolisNode):
     """Nodes that derive from this class simply combine other nodes in various
     ways, like adding, or selecting, or whatever.  Generally these function
@@ -461,6 +683,340 @@ def log_sum(logx, logy):
     return logx + math.log(1+math.exp(neg_diff))
 
 
+def compile_model(*nodes, **kwds):
+    """Compiles the graph around nodes into a CompiledModel, which samples the
+    same distribution as sample_generator(*nodes), only much faster.
+
+    The values of every node in the graph go in one array, with arrays of
+    indices saying where each node's parents and children are, so a sweep
+    updates the array in place instead of calling methods on node objects.
+    The unobserved nodes in nodes are split into blocks of nodes of the same
+    type that are not in each other's Markov blankets (not parents, children
+    or parents of children of each other); the nodes in a block are
+    conditionally independent, so a whole block is updated with one
+    vectorized Metropolis step (or Gibbs, for BernoulliNodes).  In a
+    hierarchical model, all the nodes at one level usually form a single
+    block.  Plates work like any other observed node; each one's log density
+    is a single vectorized call over its observations.
+
+    Pass seed=... to seed the model's random numbers.  Graphs with
+    FunctionNodes (or other nodes without an array_logpdf) can't be compiled,
+    and neither can unobserved BinomialNodes in nodes, which have no sampler;
+    those raise a TypeError naming the node before anything is compiled.
+    """
+    return CompiledModel(nodes, kwds.get('seed'))
+
+
+class CompiledModel(object):
+    """A graph of nodes, compiled to arrays; see compile_model.
+
+    values holds the current value of every node in the graph and logp the
+    current logconditional of every node, kept up to date as nodes change.
+    names and columns give the name and position in values of each of the
+    nodes that the model was compiled from, which are the columns of the
+    arrays that sample returns.
+    """
+    def __init__(self, nodes, seed=None):
+        self.nodes = _unique(nodes)
+        graph = _collect_graph(self.nodes)
+        _check_compilable(graph, self.nodes)
+        self.graph = graph
+        self.index = dict((node, i) for i, node in enumerate(graph))
+        # Plates' observations are kept in their _PlateFactors instead.
+        self.values = numpy.array([numpy.nan if isinstance(node, Plate) else
+            node.value for node in graph], dtype=float)
+        columns = [node for node in self.nodes if not isinstance(node,
+            Plate)]
+        self.names = [node.name for node in columns]
+        self.columns = numpy.array([self.index[node] for node in columns],
+                dtype=int)
+        self.random = numpy.random.RandomState(seed)
+        self.logp = numpy.zeros(len(graph))
+        with numpy.errstate(all='ignore'):
+            for cls, factors in _group_by_class(node for node in graph if not
+                    isinstance(node, Constant)):
+                factors = _make_factors(cls, factors, self.index)
+                self.logp[factors.indices] = factors.evaluate(self.values)
+        self.blocks = [_Block(cls, block, self.index) for cls, block in
+                _make_blocks([node for node in self.nodes if not
+                    node.observed])]
+
+    def sweep(self):
+        """Updates every unobserved node once, in place."""
+        with numpy.errstate(all='ignore'):
+            self._sweep()
+
+    def _sweep(self, adapt=False):
+        for block in self.blocks:
+            block.update(self.values, self.logp, self.random, adapt)
+
+    def acceptance_rates(self):
+        """A dict from the names of the sampled nodes to the fraction of
+        their proposals that were accepted (since adaptation stopped)."""
+        rates = {}
+        for block in self.blocks:
+            with numpy.errstate(all='ignore'):
+                block_rates = block.accepted / block.proposed
+            for node, rate in zip(block.nodes, block_rates):
+                rates[node.name] = rate
+        return rates
+
+    def sample(self, num_samples, burn=0, thin=1, out=None, adapt=False):
+        """Runs burn sweeps, then records the values of the model's nodes
+        every thin sweeps, num_samples times.  Returns an array with one row
+        per sample, and one column per node (see names); pass out to fill in
+        an existing array instead of allocating one.
+
+        With adapt, the proposals are tuned during the burn sweeps, as in
+        MetropolisNode.adapt, and frozen after."""
+        if out is None:
+            out = numpy.empty((num_samples, len(self.columns)))
+        with numpy.errstate(all='ignore'):
+            for _ in xrange(burn):
+                self._sweep(adapt)
+            if adapt:
+                for block in self.blocks:
+                    block.stop_adapting()
+            for i in xrange(num_samples):
+                for _ in xrange(thin):
+                    self._sweep()
+                out[i] = self.values[self.columns]
+        return out
+
+    def write_back(self):
+        """Copies the current values, and the proposal standard deviations
+        and acceptance counts, back into the node objects."""
+        for node, value in zip(self.graph, self.values):
+            if isinstance(node, MetropolisNode) and not node.observed:
+                if node.discrete:
+                    value = int(value)
+                node.value = value
+        for block in self.blocks:
+            for i, node in enumerate(block.nodes):
+                node.sample_stddev = block.stddev[i]
+                node.accepted = int(block.accepted[i])
+                node.proposed = int(block.proposed[i])
+
+
+class _Factors(object):
+    """Nodes of one class whose log densities are computed together."""
+    def __init__(self, cls, nodes, index):
+        self.logpdf = cls.array_logpdf
+        self.indices = numpy.array([index[node] for node in nodes], dtype=int)
+        self.parents = [numpy.array([index[getattr(node, name)] for node in
+            nodes], dtype=int) for name in cls.parent_names]
+
+    def evaluate(self, values):
+        return self.logpdf(values[self.indices], *[values[parent] for parent
+            in self.parents])
+
+
+class _PlateFactors(_Factors):
+    """Plates of one class; the log density of each plate is the sum over its
+    observations, which are all concatenated into one array."""
+    def __init__(self, cls, plates, index):
+        super(_PlateFactors, self).__init__(cls, plates, index)
+        self.data = numpy.concatenate([numpy.asarray(plate.value,
+            dtype=float) for plate in plates])
+        self.segments = numpy.repeat(numpy.arange(len(plates)),
+                [len(plate) for plate in plates])
+
+    def evaluate(self, values):
+        if len(self.indices) == 1:
+            # The common case of one plate under shared parents.
+            parents = [values[parent[0]] for parent in self.parents]
+            return numpy.array([self.logpdf(self.data, *parents).sum()])
+        parents = [values[parent][self.segments] for parent in self.parents]
+        return numpy.bincount(self.segments, weights=self.logpdf(self.data,
+            *parents), minlength=len(self.indices))
+
+
+def _make_factors(cls, nodes, index):
+    if issubclass(cls, Plate):
+        return _PlateFactors(cls, nodes, index)
+    return _Factors(cls, nodes, index)
+
+
+class _Block(object):
+    """Nodes of one class that are updated together.
+
+    Each node's children are grouped by class into _Factors, with owners
+    saying which node in the block each child belongs to; a child can only
+    belong to one node in a block, by the way blocks are made.
+    """
+    def __init__(self, cls, nodes, index):
+        self.nodes = nodes
+        self.own = _Factors(cls, nodes, index)
+        self.gibbs = issubclass(cls, BernoulliNode)
+        self.discrete = cls.discrete
+        self.outside_support = cls.array_outside_support
+        self.stddev = numpy.array([node.sample_stddev for node in nodes])
+        self.accepted = numpy.array([node.accepted for node in nodes])
+        self.proposed = numpy.array([node.proposed for node in nodes])
+        self.adaptations = max(node.adaptations for node in nodes)
+        self.children = []
+        self.owners = []
+        edges = [(child, i) for i, node in enumerate(nodes) for child in
+                _unique(node.children)]
+        for child_cls, child_edges in _group_by_class(edges,
+                key=lambda edge: edge[0]):
+            self.children.append(_make_factors(child_cls, [child for child, _
+                in child_edges], index))
+            self.owners.append(numpy.array([i for _, i in child_edges],
+                dtype=int))
+
+    def evaluate(self, values):
+        """Returns the log densities of the nodes, and of the children in
+        each _Factors, and the total for each node."""
+        own = self.own.evaluate(values)
+        children = [factors.evaluate(values) for factors in self.children]
+        return own, children, self.total(own, children)
+
+    def total(self, own, children):
+        total = own.copy()
+        for owners, logp in zip(self.owners, children):
+            total += numpy.bincount(owners, weights=logp,
+                    minlength=len(total))
+        return total
+
+    def update(self, values, logp, random, adapt=False):
+        indices = self.own.indices
+        old_values = values[indices]
+        if self.gibbs:
+            values[indices] = 1
+            evaluated_1 = self.evaluate(values)
+            values[indices] = 0
+            evaluated_0 = self.evaluate(values)
+            u = numpy.log(random.random_sample(len(indices)))
+            p = evaluated_1[2]
+            accept = u < p - numpy.logaddexp(p, evaluated_0[2])
+            values[indices] = accept
+            self.store(logp, accept, evaluated_1)
+            self.store(logp, ~accept, evaluated_0)
+            # Gibbs updates are always accepted.
+            self.accepted += 1
+            self.proposed += 1
+            return
+        candidates = old_values + self.stddev * random.standard_normal(
+                len(indices))
+        if self.discrete:
+            candidates = numpy.round(candidates)
+        inside = ~self.outside_support(candidates)
+        old_total = self.total(logp[indices], [logp[factors.indices] for
+            factors in self.children])
+        values[indices] = numpy.where(inside, candidates, old_values)
+        evaluated = self.evaluate(values)
+        u = numpy.log(random.random_sample(len(indices)))
+        accept = inside & ~(u > evaluated[2] - old_total)
+        values[indices[~accept]] = old_values[~accept]
+        self.store(logp, accept, evaluated)
+        self.accepted += accept
+        self.proposed += 1
+        if adapt:
+            self.adaptations += 1
+            step = self.adaptations**-ADAPTATION_DECAY
+            self.stddev *= numpy.exp(step * (accept -
+                TARGET_ACCEPTANCE_RATE))
+
+    def stop_adapting(self):
+        self.accepted[:] = 0
+        self.proposed[:] = 0
+
+    def store(self, logp, accept, evaluated):
+        """Caches the log densities for the nodes in accept (a boolean array)
+        and their children."""
+        own, children, _ = evaluated
+        logp[self.own.indices[accept]] = own[accept]
+        for owners, factors, child_logp in zip(self.owners, self.children,
+                children):
+            accepted = accept[owners]
+            logp[factors.indices[accepted]] = child_logp[accepted]
+
+
+def _check_compilable(graph, nodes):
+    """Raises a TypeError for the first node that compile_model can't
+    handle."""
+    for node in graph:
+        if isinstance(node, FunctionNode):
+            raise TypeError("Compiled models can't handle FunctionNodes; "
+                    "found %s" % _describe(node))
+        if (not isinstance(node, Constant) and
+                getattr(node, 'array_logpdf', None) is None):
+            raise TypeError("Compiled models can't handle %s, which has no "
+                    "array_logpdf" % _describe(node))
+    for node in nodes:
+        if isinstance(node, BinomialNode) and not node.observed:
+            raise TypeError("Compiled models can't sample unobserved "
+                    "BinomialNodes; found %s" % _describe(node))
+
+
+def _describe(node):
+    name = getattr(node, 'name', '')
+    if name:
+        return '%s %r' % (type(node).__name__, name)
+    return type(node).__name__
+
+
+def _unique(nodes):
+    seen = set()
+    unique = []
+    for node in nodes:
+        if node not in seen:
+            seen.add(node)
+            unique.append(node)
+    return unique
+
+
+def _parents(node):
+    return [getattr(node, name) for name in getattr(node, 'parent_names', ())]
+
+
+def _collect_graph(nodes):
+    """Every node connected to nodes, through parents and children."""
+    graph = _unique(nodes)
+    seen = set(graph)
+    i = 0
+    while i < len(graph):
+        for neighbor in _parents(graph[i]) + graph[i].children:
+            if neighbor not in seen:
+                seen.add(neighbor)
+                graph.append(neighbor)
+        i += 1
+    return graph
+
+
+def _group_by_class(items, key=lambda item: item):
+    """Groups items by the class of key(item), keeping them in order."""
+    groups = {}
+    order = []
+    for item in items:
+        cls = type(key(item))
+        if cls not in groups:
+            groups[cls] = []
+            order.append(cls)
+        groups[cls].append(item)
+    return [(cls, groups[cls]) for cls in order]
+
+
+def _make_blocks(nodes):
+    """Greedily splits nodes into blocks of the same class, where no node is
+    in the Markov blanket of another node in its block."""
+    blocks = []
+    for node in nodes:
+        blanket = set(_parents(node))
+        for child in node.children:
+            blanket.add(child)
+            blanket.update(_parents(child))
+        for cls, block, members in blocks:
+            if cls is type(node) and not blanket & members:
+                block.append(node)
+                members.add(node)
+                break
+        else:
+            blocks.append((type(node), [node], set([node])))
+    return [(cls, block) for cls, block, _ in blocks]
+
+
 def main():
     pass
 
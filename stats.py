@@ -2,12 +2,13 @@
 
 from __future__ import division
 
+from math import log
+
 def entropy(dist):
     """Finds the entropy of a categorical distribution (with a natural log).
 
     dist is assumed to be a list, where each entry in the list is a probability
     value; i.e., sum(dist) = 1."""
-    from math import log
     return sum(-x*log(x) for x in dist)
 
 
@@ -22,74 +23,628 @@ def h_index(dist):
     return sum(x**2 for x in dist)
 
 
+def entropy_rows(matrix, normalize=False):
+    """Finds the entropy of each row of matrix, which is either a 2-D array
+    or a scipy.sparse matrix (CSR is fastest), as an array.
+
+    Zero entries contribute nothing, as 0 log 0 = 0.  With normalize, each row
+    is divided by its sum first, so the rows can be counts (like
+    CounterMap.to_csr() gives you); all-zero rows have entropy 0.
+    """
+    import numpy
+    values, rows, num_rows = _row_entries(matrix, normalize)
+    terms = numpy.zeros_like(values)
+    nonzero = values > 0
+    terms[nonzero] = -values[nonzero] * numpy.log(values[nonzero])
+    return _sum_rows(terms, rows, num_rows)
+
+
+def h_index_rows(matrix, normalize=False):
+    """Finds the h-index of each row of matrix, which is either a 2-D array or
+    a scipy.sparse matrix, as an array.  See entropy_rows for normalize."""
+    values, rows, num_rows = _row_entries(matrix, normalize)
+    return _sum_rows(values**2, rows, num_rows)
+
+
+def _row_entries(matrix, normalize):
+    """Returns the entries of matrix as floats, along with either their row
+    numbers (for a sparse matrix) or None (for a dense one, where the entries
+    are still a 2-D array), and the number of rows."""
+    import numpy
+    from scipy.sparse import issparse
+    if issparse(matrix):
+        # Duplicate entries have to be summed before their logs are taken,
+        # and tocsr leaves them alone in a matrix that is already CSR; the
+        # copy keeps sum_duplicates from changing the caller's matrix.
+        matrix = matrix.tocsr(copy=True)
+        matrix.sum_duplicates()
+        values = matrix.data.astype(float)
+        num_rows = matrix.shape[0]
+        rows = numpy.repeat(numpy.arange(num_rows), numpy.diff(matrix.indptr))
+    else:
+        values = numpy.asarray(matrix, dtype=float)
+        if values.ndim != 2:
+            raise ValueError('Expected a 2-D array')
+        num_rows = values.shape[0]
+        rows = None
+    if normalize:
+        totals = _sum_rows(values, rows, num_rows)
+        totals[totals == 0] = 1
+        if rows is None:
+            values = values / totals[:,numpy.newaxis]
+        else:
+            values = values / totals[rows]
+    return values, rows, num_rows
+
+
+def _sum_rows(values, rows, num_rows):
+    import numpy
+    if rows is None:
+        return values.sum(axis=1)
+    return numpy.bincount(rows, weights=values, minlength=num_rows)
+
+
 def mean(nums):
     return sum(nums) / float(len(nums))
 
 
-def mean_permutation_test(data1, data2, num_samples=None):
+def mean_permutation_test(data1, data2, num_samples=None, seed=None,
+        processes=1, batch_size=None):
     """Performs a permutation test using the mean as the test statistic.
 
-    Both data1 and data2 are assumed to be lists of numerical values.  The
-    resultant value is an approximation to the exact p-value, as we use a
-    random sampling of permutations instead of enumerating all of them.
+    Both data1 and data2 are assumed to be lists (or arrays) of numerical
+    values.  The resultant value is an approximation to the exact p-value, as
+    we use a random sampling of permutations instead of enumerating all of
+    them: the fraction of permutations whose difference in means is bigger
+    than the observed one.
+
+    Permutations are drawn batch_size at a time as a matrix of shuffled
+    indices, and the means for the whole batch are computed at once.  The
+    default batch size keeps each matrix to a few million entries.  seed
+    makes the result reproducible, and processes splits the samples across
+    that many worker processes (None for one per core), each with its own
+    random stream drawn from seed.
     """
-    from copy import copy
-    from random import Random
-    r = Random()
-    n = 0
+    import numpy
     if not num_samples:
         num_samples = (len(data1) + len(data2)) * 25
-    alldata = copy(data1)
-    alldata.extend(data2)
-    true_diff = abs(mean(data1) - mean(data2))
+    alldata = numpy.concatenate([numpy.asarray(data1, dtype=float),
+        numpy.asarray(data2, dtype=float)])
     num_a = len(data1)
-    for i in xrange(num_samples):
-        r.shuffle(alldata)
-        diff = abs(mean(alldata[num_a:]) - mean(alldata[:num_a]))
-        if diff > true_diff:
-            n += 1
+    true_diff = abs(_mean_differences(alldata, alldata[:num_a].sum(), num_a))
+    if not batch_size:
+        batch_size = max(1, 2**22 // len(alldata))
+    n = sum(map_jobs(_count_mean_permutations, (alldata, num_a, true_diff,
+        batch_size), num_samples, seed, processes))
     return n/num_samples
 
 
-def paired_permutation_test(data1, data2, weights=None):
-    """Performs an exact a paired permutation test.
+def _mean_differences(alldata, sums_a, num_a):
+    """The difference between the mean of the last len(alldata) - num_a
+    values and the first num_a, given the sum of the first num_a.  If
+    alldata is 2-D, each column is a separate data set."""
+    total = alldata.sum(axis=0)
+    return (total - sums_a) / (len(alldata) - num_a) - sums_a / num_a
+
+
+def _count_mean_permutations(job):
+    import numpy
+    (alldata, num_a, true_diff, batch_size), num_samples, seed = job
+    random = numpy.random.RandomState(seed)
+    n = 0
+    while num_samples > 0:
+        batch = min(batch_size, num_samples)
+        num_samples -= batch
+        # The first num_a columns of a random ordering of each row are a
+        # random subset; argpartition finds them without a full sort.
+        keys = random.random_sample((batch, len(alldata)))
+        subsets = keys.argpartition(num_a - 1, axis=1)[:,:num_a]
+        sums_a = alldata[subsets].sum(axis=1)
+        diffs = abs(_mean_differences(alldata, sums_a, num_a))
+        n += int((diffs > true_diff).sum())
+    return n
+
+
+def map_jobs(function, arguments, num_samples, seed, processes):
+    """Splits num_samples between processes jobs, gives each a seed drawn from
+    seed, and returns a list of function((arguments, samples, seed)) for each
+    job, computed in a pool of processes if there is more than one."""
+    import numpy
+    num_jobs = processes or 1
+    if processes != 1:
+        from multiprocessing import Pool, cpu_count
+        if processes is None:
+            num_jobs = cpu_count()
+    seeds = numpy.random.RandomState(seed).randint(2**31, size=num_jobs)
+    jobs = []
+    for i in range(num_jobs):
+        samples = num_samples // num_jobs + (i < num_samples % num_jobs)
+        jobs.append((arguments, samples, seeds[i]))
+    if processes == 1:
+        return map(function, jobs)
+    pool = Pool(processes)
+    results = pool.map(function, jobs)
+    pool.close()
+    pool.join()
+    return results
+
+
+def multiple_permutation_test(baseline, systems, paired=False,
+        num_samples=None, seed=None, processes=1, batch_size=None):
+    """Tests each of several systems against a baseline with one shared set of
+    permutations, correcting for the number of comparisons.
+
+    systems is a list of lists (or a 2-D array) with one row per system; the
+    rows must all be the same length, and the same length as baseline if
+    paired.  Unpaired, this is mean_permutation_test for each system: each
+    sample picks which of the pooled positions count as the baseline, as one
+    0/1 indicator matrix that is multiplied by all the systems' pooled data
+    at once.  Paired, this is a Monte Carlo paired_permutation_test on the
+    differences from the baseline, with one matrix of random signs for all of
+    the systems.  Either way the work per sample is a single matrix product,
+    so the time grows about linearly with the number of systems.
+
+    Returns two arrays of p-values, one per system: the raw ones, and ones
+    corrected with the max-T method (the fraction of samples in which the
+    largest statistic across all the systems beats the system's observed
+    one), which control the family-wise error rate.  The statistics are
+    standardized by their permutation standard deviation so that systems
+    with noisier data don't dominate the maximum.  See mean_permutation_test
+    for the other arguments.
+    """
+    import numpy
+    baseline = numpy.asarray(baseline, dtype=float)
+    systems = numpy.asarray(systems, dtype=float)
+    if systems.ndim != 2:
+        raise ValueError('systems should have one row per system, all the'
+                ' same length')
+    if paired:
+        if systems.shape[1] != len(baseline):
+            raise ValueError('This is a _paired_ test and you gave me data'
+                    ' with unequal lengths!')
+        data = systems - baseline
+        scale = (data**2).sum(axis=1)**.5
+        observed = abs(data.sum(axis=1))
+        num_a = None
+    else:
+        data = numpy.hstack([numpy.tile(baseline, (len(systems), 1)),
+            systems])
+        scale = data.std(axis=1)
+        num_a = len(baseline)
+        observed = abs(_mean_differences(data.T, data[:,:num_a].sum(axis=1),
+            num_a))
+    scale[scale == 0] = 1
+    observed /= scale
+    if not num_samples:
+        num_samples = data.shape[1] * 25
+    if not batch_size:
+        batch_size = max(1, 2**22 // (data.shape[1] + len(data)))
+    results = map_jobs(_count_multiple_permutations, (data, num_a, observed,
+        scale, batch_size), num_samples, seed, processes)
+    raw = sum(r[0] for r in results)
+    corrected = sum(r[1] for r in results)
+    return raw / num_samples, corrected / num_samples
+
+
+def _count_multiple_permutations(job):
+    import numpy
+    (data, num_a, observed, scale, batch_size), num_samples, seed = job
+    random = numpy.random.RandomState(seed)
+    raw = numpy.zeros(len(data), dtype=int)
+    corrected = numpy.zeros(len(data), dtype=int)
+    if num_a is None:
+        slack = 1e-9 * abs(data).sum(axis=1) / scale
+    while num_samples > 0:
+        batch = min(batch_size, num_samples)
+        num_samples -= batch
+        if num_a is None:
+            signs = random.randint(2, size=(batch, data.shape[1])) * 2 - 1
+            statistics = abs(signs.dot(data.T)) / scale
+            # Like paired_permutation_test, count ties, with some slack for
+            # rounding.
+            beats = statistics >= observed - slack
+            best = statistics.max(axis=1)[:,numpy.newaxis] >= observed - slack
+        else:
+            keys = random.random_sample((batch, data.shape[1]))
+            subsets = keys.argpartition(num_a - 1, axis=1)[:,:num_a]
+            indicators = numpy.zeros((batch, data.shape[1]))
+            indicators[numpy.arange(batch)[:,numpy.newaxis], subsets] = 1
+            sums_a = indicators.dot(data.T)
+            statistics = abs(_mean_differences(data.T, sums_a, num_a)) / scale
+            beats = statistics > observed
+            best = statistics.max(axis=1)[:,numpy.newaxis] > observed
+        raw += beats.sum(axis=0)
+        corrected += best.sum(axis=0)
+    return raw, corrected
+
+
+def paired_permutation_test(data1, data2, weights=None, method='auto',
+        tolerance=.001, resolution=None, seed=None, batch_size=None):
+    """Performs a paired permutation test.
 
     We create an array of the signed difference between the two data points,
-    find the mean difference, and then test for all possible permutations of
-    the signs if the new mean difference is higher than the original mean
-    difference.
+    find the mean difference, and then compute the fraction of all the ways
+    of flipping the signs of the differences for which the new mean
+    difference is at least as high as the original mean difference.
+
+    There are 2^n ways to flip the signs, so there are a few ways to do it:
+
+    'enumerate' lists every sum of flipped differences, by doubling an array
+        of partial sums once per difference.  This is exact, but only
+        practical up to n of about 20.
+    'exact' computes the distribution of the sum directly, which works when
+        the differences are integers (or multiples of resolution, if given;
+        other differences are rounded to the nearest multiple).  Identical
+        differences contribute a binomial distribution, and the distributions
+        for the distinct differences are convolved with FFTs, so this stays
+        fast for thousands of differences that take few distinct values.
+    'monte_carlo' samples random sign matrices batch_size rows at a time,
+        until the standard error of the estimate is below tolerance.  seed
+        makes it reproducible.
+    'auto' (the default) picks enumerate for n <= 20, then exact if the
+        differences are integers (or resolution is given) and their sum isn't
+        too big, and monte_carlo otherwise.
+
+    Weights scale each difference; the total weight doesn't matter.
     """
+    import numpy
     if len(data1) != len(data2):
         raise ValueError('This is a _paired_ test and you gave me data with'
                 ' unequal lengths!')
     if weights and len(weights) != len(data1):
         raise ValueError("You passed weights that don't match the data")
-    from itertools import izip
-    diffs = [x-y for x,y in izip(data1, data2)]
+    diffs = numpy.asarray(data1, dtype=float) - numpy.asarray(data2,
+            dtype=float)
     if weights:
-        total_weight = sum(weights)
-        for i in range(len(diffs)):
-            diffs[i] = diffs[i] * weights[i] / total_weight
-    length = len(diffs)
-    mean_diff = abs(sum(diffs)/length)
-    n = 0
-    for i in range(2**len(diffs)):
-        a = i
-        index = 1
-        diff = 0
-        while index <= length:
-            if a%2 == 1:
-                diff -= diffs[-index]
+        # Dividing by the total weight as well would scale every sum of
+        # flipped differences by the same amount, which can't change which of
+        # them are at least as big as the true one.
+        diffs = diffs * numpy.asarray(weights, dtype=float)
+    if method == 'auto':
+        if len(diffs) <= 20:
+            method = 'enumerate'
+        elif _exact_paired_test_size(diffs, resolution) <= 10**7:
+            method = 'exact'
+        else:
+            method = 'monte_carlo'
+    if method == 'enumerate':
+        sums = numpy.zeros(1)
+        for diff in diffs:
+            sums = numpy.concatenate([sums + diff, sums - diff])
+        return (_at_least(sums, diffs)).mean()
+    elif method == 'exact':
+        return _exact_paired_test(diffs, resolution)
+    elif method == 'monte_carlo':
+        return _monte_carlo_paired_test(diffs, tolerance, seed, batch_size)
+    raise ValueError('Unknown method: %s' % method)
+
+
+def _at_least(sums, diffs):
+    """Which of the sums of flipped diffs are at least as far from zero as the
+    sum of diffs itself, with some slack for rounding errors."""
+    slack = 1e-9 * abs(diffs).sum()
+    return abs(sums) >= abs(diffs.sum()) - slack
+
+
+def _integer_diffs(diffs, resolution):
+    import numpy
+    if resolution:
+        return numpy.round(diffs / resolution).astype(numpy.int64)
+    return diffs.astype(numpy.int64)
+
+
+def _exact_paired_test_size(diffs, resolution):
+    """The length of the distribution _exact_paired_test would build, or
+    infinity if the diffs aren't integers and there's no resolution."""
+    import numpy
+    if not resolution and not (numpy.round(diffs) == diffs).all():
+        return float('inf')
+    return abs(_integer_diffs(diffs, resolution)).sum() + 1
+
+
+def _exact_paired_test(diffs, resolution):
+    import numpy
+    from scipy.signal import fftconvolve
+    from scipy.stats import binom
+    diffs = _integer_diffs(diffs, resolution)
+    sizes = abs(diffs)
+    # dist[f] is the probability that the flipped differences have sizes
+    # adding up to f, which makes the sum of signed differences
+    # sizes.sum() - 2*f.
+    dists = [numpy.ones(1)]
+    values, counts = numpy.unique(sizes[sizes > 0], return_counts=True)
+    for value, count in zip(values, counts):
+        term = numpy.zeros(value * count + 1)
+        term[::value] = binom.pmf(numpy.arange(count + 1), count, .5)
+        dists.append(term)
+    # Convolving in pairs keeps the arrays being convolved about the same
+    # size, which is where FFTs are the biggest win.
+    while len(dists) > 1:
+        paired = []
+        for a, b in zip(dists[::2], dists[1::2]):
+            if min(len(a), len(b)) > 500:
+                paired.append(numpy.maximum(fftconvolve(a, b), 0))
             else:
-                diff += diffs[-index]
-            if a > 0:
-                a = a>>1
-            index += 1
-        diff = abs(diff/length)
-        if diff >= mean_diff:
-            n += 1
-    return n/2**len(diffs)
+                paired.append(numpy.convolve(a, b))
+        if len(dists) % 2:
+            paired.append(dists[-1])
+        dists = paired
+    dist = dists[0]
+    sums = sizes.sum() - 2 * numpy.arange(len(dist))
+    return min(1.0, dist[abs(sums) >= abs(diffs.sum())].sum())
+
+
+def _monte_carlo_paired_test(diffs, tolerance, seed, batch_size):
+    import numpy
+    random = numpy.random.RandomState(seed)
+    if not batch_size:
+        batch_size = max(100, 2**22 // len(diffs))
+    n = 0
+    num_samples = 0
+    while True:
+        signs = random.randint(2, size=(batch_size, len(diffs))) * 2 - 1
+        n += int(_at_least(signs.dot(diffs), diffs).sum())
+        num_samples += batch_size
+        # The standard error of the estimate, with a bit of smoothing so that
+        # a p-value near 0 doesn't look certain after the first batch.
+        p = (n + 1) / (num_samples + 2)
+        if (p * (1 - p) / num_samples)**.5 <= tolerance:
+            return n / num_samples
+
+
+class _Accumulator(object):
+    """Shared plumbing for the streaming accumulators below.
+
+    Subclasses define add, add_chunk and merge; update feeds them an iterator
+    a chunk at a time, so nothing bigger than a chunk is ever in memory.
+    Accumulators pickle, so each process can build its own over part of the
+    data and send it back to be merged.
+    """
+    def update(self, values, chunk_size=65536):
+        from itertools import islice
+        values = iter(values)
+        while True:
+            chunk = list(islice(values, chunk_size))
+            if not chunk:
+                return self
+            self.add_chunk(chunk)
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+
+class RunningMoments(_Accumulator):
+    """Keeps the count, mean and variance of a stream of numbers.
+
+    add uses Welford's update, and add_chunk and merge use Chan et al.'s
+    formula for combining the moments of two sets, which avoids the
+    cancellation you get from keeping sums of squares.
+    """
+    def __init__(self, values=None):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        if values is not None:
+            self.update(values)
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    def add_chunk(self, values):
+        import numpy
+        values = numpy.asarray(values, dtype=float)
+        if len(values):
+            mean = values.mean()
+            self._combine(len(values), mean, ((values - mean)**2).sum())
+
+    def merge(self, other):
+        if other.n:
+            self._combine(other.n, other.mean, other.m2)
+        return self
+
+    def _combine(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta**2 * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+
+    def variance(self, ddof=0):
+        if self.n - ddof <= 0:
+            return float('nan')
+        return self.m2 / (self.n - ddof)
+
+    def stddev(self, ddof=0):
+        return self.variance(ddof)**.5
+
+
+class RunningEntropy(_Accumulator):
+    """Counts a stream of categorical values, to find the entropy (or h-index)
+    of their distribution.
+
+    Memory is proportional to the number of distinct values, not the length
+    of the stream.  add takes an optional count, so this can also total up
+    counts that were made elsewhere.
+    """
+    def __init__(self, values=None):
+        self.counts = {}
+        self.total = 0
+        if values is not None:
+            self.update(values)
+
+    def add(self, value, count=1):
+        self.counts[value] = self.counts.get(value, 0) + count
+        self.total += count
+
+    def add_chunk(self, values):
+        from collections import Counter
+        for value, count in Counter(values).iteritems():
+            self.add(value, count)
+
+    def merge(self, other):
+        for value, count in other.counts.iteritems():
+            self.add(value, count)
+        return self
+
+    def entropy(self):
+        """The same as entropy(dist) for the normalized counts, computed as
+        log(N) - sum(c log c) / N to avoid dividing each count."""
+        if not self.total:
+            return 0.0
+        return log(self.total) - sum(c * log(c) for c in
+                self.counts.itervalues() if c > 0) / self.total
+
+    def h_index(self):
+        if not self.total:
+            return 0.0
+        return sum(c**2 for c in self.counts.itervalues()) / self.total**2
+
+
+class QuantileSketch(_Accumulator):
+    """Approximates the quantiles of a stream of numbers in bounded memory.
+
+    This is a KLL sketch: a stack of buffers, where each item in buffer h
+    stands for 2^h of the original values.  When the buffers fill up, the
+    lowest full one is sorted and every other item (starting at a random
+    offset) is promoted to the buffer above.  The top buffers hold k items
+    and lower ones shrink geometrically, so memory stays O(k) and the rank
+    error is about 1.7/k of the number of values, no matter how long the
+    stream is.  Sketches with the same k can be merged.
+    """
+    def __init__(self, k=200, values=None, seed=None):
+        import random
+        self.k = k
+        self.n = 0
+        self.buffers = [[]]
+        self.random = random.Random(seed)
+        if values is not None:
+            self.update(values)
+
+    def add(self, value):
+        self.buffers[0].append(value)
+        self.n += 1
+        self._compress()
+
+    def add_chunk(self, values):
+        for value in values:
+            self.buffers[0].append(value)
+            self.n += 1
+            if len(self.buffers[0]) >= self._capacity(0):
+                self._compress()
+
+    def merge(self, other):
+        if other.k != self.k:
+            raise ValueError('Can only merge sketches with the same k')
+        while len(self.buffers) < len(other.buffers):
+            self.buffers.append([])
+        for buffer, other_buffer in zip(self.buffers, other.buffers):
+            buffer.extend(other_buffer)
+        self.n += other.n
+        self._compress()
+        return self
+
+    def _capacity(self, height):
+        depth = len(self.buffers) - height - 1
+        return max(2, int(self.k * (2 / 3)**depth))
+
+    def _compress(self):
+        for height in xrange(len(self.buffers)):
+            buffer = self.buffers[height]
+            if len(buffer) < self._capacity(height):
+                continue
+            if height + 1 == len(self.buffers):
+                self.buffers.append([])
+            buffer.sort()
+            # An odd item out stays behind, so the total weight is kept.
+            keep = [buffer.pop()] if len(buffer) % 2 else []
+            offset = self.random.randint(0, 1)
+            self.buffers[height + 1].extend(buffer[offset::2])
+            self.buffers[height] = keep
+
+    def _weighted_items(self):
+        items = []
+        for height, buffer in enumerate(self.buffers):
+            items.extend((value, 2**height) for value in buffer)
+        items.sort()
+        return items
+
+    def quantile(self, q):
+        """The approximate value below which a fraction q of the stream falls.
+        """
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        items = self._weighted_items()
+        if not items:
+            raise ValueError('No values in the sketch')
+        total = sum(weight for _, weight in items)
+        results = []
+        for q in qs:
+            target = q * total
+            seen = 0
+            for value, weight in items:
+                seen += weight
+                if seen >= target:
+                    break
+            results.append(value)
+        return results
+
+    def rank(self, value):
+        """The approximate fraction of the stream that is <= value."""
+        items = self._weighted_items()
+        total = sum(weight for _, weight in items)
+        if not total:
+            return 0.0
+        return sum(weight for v, weight in items if v <= value) / total
+
+
+class RunningHistogram(_Accumulator):
+    """Counts a stream of numbers in fixed bins.
+
+    Either pass the bin edges, or a number of bins and a (low, high) range to
+    split evenly.  Values below the first edge or above the last are counted
+    in underflow and overflow instead of being dropped.  Histograms with the
+    same edges can be merged.
+    """
+    def __init__(self, bins=10, range=None, values=None):
+        import numpy
+        if range is not None:
+            self.edges = numpy.linspace(range[0], range[1], bins + 1)
+        else:
+            self.edges = numpy.asarray(bins, dtype=float)
+            if self.edges.ndim != 1 or len(self.edges) < 2:
+                raise ValueError('Give either a list of bin edges, or a '
+                        'number of bins and a range')
+        self.counts = numpy.zeros(len(self.edges) - 1, dtype=numpy.int64)
+        self.underflow = 0
+        self.overflow = 0
+        if values is not None:
+            self.update(values)
+
+    def add(self, value):
+        self.add_chunk([value])
+
+    def add_chunk(self, values):
+        import numpy
+        values = numpy.asarray(values, dtype=float)
+        self.underflow += int((values < self.edges[0]).sum())
+        self.overflow += int((values > self.edges[-1]).sum())
+        self.counts += numpy.histogram(values, self.edges)[0]
+
+    def merge(self, other):
+        if len(self.edges) != len(other.edges) or (self.edges !=
+                other.edges).any():
+            raise ValueError('Can only merge histograms with the same bins')
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
 
+    def total(self):
+        return int(self.counts.sum()) + self.underflow + self.overflow
 
 
 # vim: et sw=4 sts=4
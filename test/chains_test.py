@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# Checks that run_chains fails cleanly when one chain's process dies in the
+# middle of a chunk, instead of hanging on the others, and that it handles
+# chunks too small to check for convergence on.
+
+import os
+import signal
+from multiprocessing import Value
+from mcmc import NormalNode, Constant, normal_logpdf, run_chains
+
+NUM_NODES = 60
+# How many log densities the doomed chain computes before it dies: well past
+# its burn sweeps, but before its first chunk is done.
+CALLS_BEFORE_DYING = 200
+
+# The chains count themselves as they build their models, so that only one
+# of them dies.
+chains_built = Value('i', 0)
+logpdf_calls = 0
+
+class Hang(Exception):
+    pass
+
+
+class DyingNormalNode(NormalNode):
+    """A NormalNode whose process exits abruptly, like it was killed, after
+    CALLS_BEFORE_DYING log densities."""
+    @staticmethod
+    def array_logpdf(x, mean, var):
+        global logpdf_calls
+        logpdf_calls += 1
+        if logpdf_calls > CALLS_BEFORE_DYING:
+            os._exit(1)
+        return normal_logpdf(x, mean, var)
+
+
+def main():
+    signal.signal(signal.SIGALRM, hang)
+    signal.alarm(120)
+    try:
+        run_chains(build_dying_model, num_chains=3, seed=0, max_samples=2000,
+                burn=10)
+    except RuntimeError, e:
+        print 'Got a RuntimeError when a chain died:', e
+    else:
+        raise AssertionError('A chain died and nothing was raised')
+    signal.alarm(0)
+
+    for parallel in True, False:
+        chains = run_chains(build_model, num_chains=2, seed=0, max_samples=6,
+                chunk_size=1, parallel=parallel)
+        assert chains.samples.shape == (2, 6, NUM_NODES)
+    try:
+        run_chains(build_model, max_samples=3, parallel=False)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('max_samples=3 was accepted')
+    print 'All good'
+
+
+def build_model(node_class=NormalNode):
+    mean = Constant(0.)
+    var = Constant(1.)
+    return [node_class(0., 'x%d' % i, mean=mean, var=var) for i in
+            xrange(NUM_NODES)]
+
+
+def build_dying_model():
+    with chains_built.get_lock():
+        chains_built.value += 1
+        number = chains_built.value
+    if number == 2:
+        return build_model(DyingNormalNode)
+    return build_model()
+
+
+def hang(*args):
+    raise Hang('run_chains hung after a chain died')
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: et sw=4 sts=4
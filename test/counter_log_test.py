@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Checks that a CounterMapLog recovers the right counts after crashes at each
+# step of appending and compacting, by simulating the crashes.
+
+import os
+import shutil
+import tempfile
+from counter import CounterMap, CounterMapLog
+
+class Crash(Exception):
+    pass
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'counts.log')
+        log = CounterMapLog(filename)
+        expected = CounterMap()
+        for position in xrange(1, 4):
+            append(log, expected, position)
+        check(filename, expected, 3, 'after appending')
+
+        # A crash in the middle of an append leaves part of a record, which
+        # is dropped.
+        f = open(filename, 'ab')
+        f.write('\x10\x00\x00\x00partial')
+        f.close()
+        check(filename, expected, 3, 'after a crash during an append')
+
+        log = CounterMapLog(filename)
+        log.compact(log.recover()[0])
+        check(filename, expected, 3, 'after compacting')
+        append(log, expected, 4)
+        check(filename, expected, 4, 'after appending to a compacted log')
+
+        # A crash after the snapshot is in place, but before the log is
+        # emptied: the log's records are all in the snapshot already.
+        start_log = CounterMapLog._start_log
+        CounterMapLog._start_log = crash
+        try:
+            log.compact(log.recover()[0])
+        except Crash:
+            pass
+        CounterMapLog._start_log = start_log
+        check(filename, expected, 4, 'after a crash before emptying the log')
+        log = CounterMapLog(filename)
+        append(log, expected, 5)
+        check(filename, expected, 5, 'after appending past that crash')
+        log.compact(log.recover()[0])
+        check(filename, expected, 5, 'after compacting past that crash')
+
+        # A crash before the new snapshot is renamed into place leaves the
+        # old snapshot and the whole log.
+        append(log, expected, 6)
+        rename = os.rename
+        os.rename = crash
+        try:
+            log.compact(log.recover()[0])
+        except Crash:
+            pass
+        os.rename = rename
+        check(filename, expected, 6, 'after a crash before the rename')
+    finally:
+        shutil.rmtree(directory)
+    print 'All good'
+
+
+def append(log, expected, position):
+    delta = CounterMap()
+    for i in xrange(position):
+        delta.incrementCount('row%d' % (i % 3), u'caf\xe9%d' % i, i + 1)
+        delta.incrementCount(u'r\xf6w', 'value', 1)
+    log.append(delta, position)
+    expected.merge(delta)
+
+
+def crash(*args):
+    raise Crash()
+
+
+def check(filename, expected, expected_position, when):
+    counts, position = CounterMapLog(filename).recover()
+    assert position == expected_position, (when, position)
+    assert sorted(expected.keySet()) == sorted(counts.keySet()), when
+    for key in expected.keySet():
+        assert sorted(expected[key].items()) == sorted(counts[key].items()), \
+                (when, key)
+    print 'Recovered the right counts', when
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+from __future__ import division
+from datetime import datetime
+import sys
+import numpy
+from cluster import initial_means, lloyd, hamerly
+
+def main():
+    if len(sys.argv) > 1:
+        num_points = int(sys.argv[1])
+    else:
+        num_points = 100000
+    dims = 16
+    iterations = 20
+    r = numpy.random.RandomState(0)
+    centers = r.uniform(-10, 10, size=(200, dims))
+    points = centers[r.randint(len(centers), size=num_points)]
+    points += r.normal(size=points.shape)
+    print 'Clustering', num_points, 'points with', dims, 'dimensions,',
+    print 'for', iterations, 'iterations'
+    for k in [100, 1000, 5000]:
+        means = initial_means(points, k, init='k-means++', seed=0)
+        start = datetime.now()
+        lloyd_labels, _ = lloyd(points, means.copy(), 2, iterations)
+        lloyd_time = seconds_since(start)
+        start = datetime.now()
+        hamerly_labels, _ = hamerly(points, means.copy(), 2, iterations)
+        hamerly_time = seconds_since(start)
+        agreement = (lloyd_labels == hamerly_labels).mean()
+        print 'k=%d: lloyd took %.2f seconds, hamerly took %.2f seconds' \
+                ' (%.1fx), labels agree on %.4f of the points' % (k,
+                        lloyd_time, hamerly_time, lloyd_time / hamerly_time,
+                        agreement)
+
+
+def seconds_since(start):
+    delta = datetime.now() - start
+    return delta.seconds + delta.microseconds / 1000000.0
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+from __future__ import division
+from datetime import datetime
+import random
+import sys
+from mcmc import NormalNode, InvGammaNode, Constant, sample_generator, \
+        compile_model
+
+def main():
+    if len(sys.argv) > 1:
+        num_groups = int(sys.argv[1])
+    else:
+        num_groups = 2000
+    per_group = 4
+    sweeps = 20
+    nodes = hierarchical_model(num_groups, per_group)
+    print 'Sampling a hierarchical normal model with', num_groups, 'groups',
+    print 'of', per_group, 'observations, for', sweeps, 'sweeps'
+    random.seed(0)
+    generator = sample_generator(*nodes, output_rate=sweeps + 1)
+    start = datetime.now()
+    for _ in xrange(sweeps):
+        next(generator)
+    object_time = seconds_since(start)
+    start = datetime.now()
+    model = compile_model(*hierarchical_model(num_groups, per_group), seed=0)
+    compile_time = seconds_since(start)
+    start = datetime.now()
+    model.sample(sweeps)
+    compiled_time = seconds_since(start)
+    print 'node objects took %.2f seconds, the compiled model took %.2f' \
+            ' seconds (%.1fx), plus %.2f seconds to compile' % (object_time,
+                    compiled_time, object_time / compiled_time, compile_time)
+
+
+def hierarchical_model(num_groups, per_group):
+    r = random.Random(0)
+    mean = NormalNode(0, 'mean', Constant(0), Constant(100))
+    var = InvGammaNode(1, 'var', Constant(2), Constant(2))
+    nodes = [mean, var]
+    for i in xrange(num_groups):
+        group_mean = NormalNode(0, 'mean%d' % i, mean, var)
+        center = r.gauss(0, 1)
+        for _ in xrange(per_group):
+            NormalNode(r.gauss(center, 1), observed=True, mean=group_mean,
+                    var=Constant(1))
+        nodes.append(group_mean)
+    return nodes
+
+
+def seconds_since(start):
+    delta = datetime.now() - start
+    return delta.seconds + delta.microseconds / 1000000.0
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: et sw=4 sts=4
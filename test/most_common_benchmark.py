@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+from __future__ import division
+from datetime import datetime
+from heapq import heappush
+from random import Random
+import sys
+from counter import Counter, ArrayCounter, SpaceSavingCounter
+
+def main():
+    if len(sys.argv) > 1:
+        num_keys = int(sys.argv[1])
+    else:
+        num_keys = 10000000
+    k = 50
+    r = Random(0)
+    print 'Building counters with', num_keys, 'keys'
+    counter = Counter()
+    array_counter = ArrayCounter()
+    for i in xrange(num_keys):
+        key = 'key%d' % i
+        count = r.randint(1, 1000000)
+        counter.setCount(key, count)
+        array_counter.setCount(key, count)
+
+    start = datetime.now()
+    top = heap_sorted(counter)[:k]
+    report('Heap-based Counter.sorted()[:%d] (the old version)' % k, start)
+    start = datetime.now()
+    assert counter.sorted()[:k] == top
+    report('Counter.sorted()[:%d]' % k, start)
+    start = datetime.now()
+    assert counter.most_common(k) == top
+    report('Counter.most_common(%d)' % k, start)
+    start = datetime.now()
+    assert array_counter.sorted()[:k] == top
+    report('ArrayCounter.sorted()[:%d]' % k, start)
+    start = datetime.now()
+    assert array_counter.most_common(k) == top
+    report('ArrayCounter.most_common(%d)' % k, start)
+
+    print 'Streaming', num_keys, 'zipfian tokens through a SpaceSavingCounter'
+    heavy_hitters = SpaceSavingCounter(10 * k)
+    exact = Counter()
+    tokens = [int(r.paretovariate(1)) for i in xrange(num_keys)]
+    start = datetime.now()
+    for token in tokens:
+        heavy_hitters.incrementCount(token)
+    report('SpaceSavingCounter.incrementCount', start)
+    start = datetime.now()
+    for token in tokens:
+        exact.incrementCount(token, 1)
+    report('Counter.incrementCount', start)
+    found = set(key for _, key in heavy_hitters.most_common(k))
+    true = set(key for _, key in exact.most_common(k))
+    print 'Recovered %d of the true top %d keys, using %d entries instead' \
+            ' of %d' % (len(found & true), k, heavy_hitters.size(),
+                    exact.size())
+
+
+def heap_sorted(counter):
+    """Counter.sorted as it used to be, to compare against."""
+    heap = []
+    for item in counter.keySet():
+        heappush(heap, (counter.getCount(item), item))
+    heap.sort()
+    heap.reverse()
+    return heap
+
+
+def report(name, start):
+    delta = datetime.now() - start
+    print name, 'took', delta.seconds + delta.microseconds / 1000000.0,
+    print 'seconds'
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: et sw=4 sts=4
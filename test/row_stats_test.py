@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+# Checks that entropy_rows and h_index_rows agree with entropy and h_index on
+# each row, for lists, arrays and sparse matrices (including ones with
+# duplicate entries).
+
+import numpy
+from scipy.sparse import csr_matrix
+from stats import entropy, h_index, entropy_rows, h_index_rows
+
+def main():
+    rows = [[.5, .5, 0], [1, 0, 0], [.2, .3, .5]]
+    expected_entropy = [entropy([x for x in row if x]) for row in rows]
+    expected_h_index = [h_index(row) for row in rows]
+    # The same rows, with some values split over duplicate entries.
+    duplicates = csr_matrix(([.25, .25, .5, 1, .2, .1, .2, .5],
+        [0, 0, 1, 0, 0, 1, 1, 2], [0, 3, 4, 8]), shape=(3, 3))
+    for matrix in rows, numpy.array(rows), csr_matrix(rows), duplicates:
+        check(entropy_rows(matrix), expected_entropy, 'entropy', matrix)
+        check(h_index_rows(matrix), expected_h_index, 'h-index', matrix)
+    counts = [[1, 1, 0], [3, 0, 0], [0, 0, 0]]
+    check(entropy_rows(counts, normalize=True), [numpy.log(2), 0, 0],
+            'normalized entropy', counts)
+    assert not duplicates.has_canonical_format, 'The input was changed'
+    print 'All good'
+
+
+def check(actual, expected, what, matrix):
+    if not numpy.allclose(actual, expected):
+        raise AssertionError('Wrong %s for %s %r: %s instead of %s' % (what,
+            type(matrix).__name__, matrix, actual, expected))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: et sw=4 sts=4